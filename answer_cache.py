@@ -0,0 +1,175 @@
+import re
+import time
+import random
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Простое число больше 2^64 для хэш-функций вида (a*x + b) mod p
+_MERSENNE_PRIME = (1 << 89) - 1
+_MAX_HASH = (1 << 64) - 1
+
+
+def normalize_question(text):
+    """Нормализация вопроса: регистр, апострофы, пунктуация, пробелы"""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[’ʼ'`]", "", text)
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def numbers(text):
+    """Числа в тексте по порядку: дозы, вес, давление и т.п."""
+    return re.findall(r"\d+", text)
+
+
+def shingles(text, size=3):
+    """Символьные n-граммы нормализованного текста"""
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class MinHasher:
+    """MinHash-сигнатуры для оценки сходства Жаккара по n-граммам"""
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = random.Random(seed)
+        self.permutations = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, text):
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+            for s in shingles(text)
+        ]
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self.permutations
+        )
+
+
+def similarity(sig_a, sig_b):
+    """Оценка сходства Жаккара по двум сигнатурам"""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+class AnswerCache:
+    """Кэш ответов на повторяющиеся вопросы без контекста разговора.
+
+    Вопрос ищется сначала по нормализованному тексту, затем среди
+    похожих формулировок (MinHash с LSH-корзинами, порог threshold).
+    Похожий вопрос подходит, только если числа в нем те же самые:
+    "собаке 5 кг" и "собаке 25 кг" почти совпадают по тексту, но ответы
+    на них разные. Записи живут ttl секунд, при переполнении вытесняются по LRU.
+    """
+
+    def __init__(self, max_entries=2000, ttl=24 * 3600, threshold=0.8,
+                 num_perm=64, bands=16, max_question_length=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_question_length = max_question_length
+        self.hasher = MinHasher(num_perm)
+        # нормализованный вопрос -> (время записи, сигнатура, ответ)
+        self.entries = OrderedDict()
+        # (номер полосы, значения полосы) -> множество вопросов
+        self.buckets = {}
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def cacheable(self, question):
+        return len(question) <= self.max_question_length
+
+    def get(self, question):
+        """Ответ на такой же или почти такой же вопрос (None, если его нет)"""
+        if not self.cacheable(question):
+            return None
+        key = normalize_question(question)
+        if not key:
+            return None
+        entry = self._live_entry(key)
+        if entry is not None:
+            self.exact_hits += 1
+            return entry[2]
+
+        signature = self.hasher.signature(key)
+        key_numbers = numbers(key)
+        best_key, best_score = None, self.threshold
+        for candidate in self._candidates(signature):
+            if numbers(candidate) != key_numbers:
+                continue
+            entry = self._live_entry(candidate)
+            if entry is None:
+                continue
+            score = similarity(signature, entry[1])
+            if score >= best_score:
+                best_key, best_score = candidate, score
+        if best_key is not None:
+            self.near_hits += 1
+            logger.info(f"Похожий вопрос найден в кэше (сходство {best_score:.2f})")
+            return self.entries[best_key][2]
+        self.misses += 1
+        return None
+
+    def put(self, question, answer):
+        if not self.cacheable(question):
+            return
+        key = normalize_question(question)
+        if not key:
+            return
+        if key in self.entries:
+            self._remove(key)
+        signature = self.hasher.signature(key)
+        self.entries[key] = (time.monotonic(), signature, answer)
+        for band in self._bands(signature):
+            self.buckets.setdefault(band, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def stats(self):
+        total = self.exact_hits + self.near_hits + self.misses
+        hits = self.exact_hits + self.near_hits
+        return {
+            "entries": len(self.entries),
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+    def _live_entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _bands(self, signature):
+        for i in range(self.bands):
+            yield i, signature[i * self.rows:(i + 1) * self.rows]
+
+    def _candidates(self, signature):
+        found = set()
+        for band in self._bands(signature):
+            found.update(self.buckets.get(band, ()))
+        return found
+
+    def _remove(self, key):
+        _, signature, _ = self.entries.pop(key)
+        for band in self._bands(signature):
+            bucket = self.buckets.get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[band]
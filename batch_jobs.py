@@ -0,0 +1,86 @@
+import re
+import logging
+import asyncio
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def make_custom_id(*parts):
+    """custom_id для Message Batches API: до 64 символов [a-zA-Z0-9_-]"""
+    return re.sub(r"[^a-zA-Z0-9_-]", "_", "-".join(str(p) for p in parts))[:64]
+
+
+class BatchJobRunner:
+    """Неинтерактивная массовая работа через Message Batches API.
+
+    Запросы отправляются одним пакетом (вдвое дешевле и не занимают
+    общие с живыми пользователями лимиты), пакет опрашивается до
+    завершения, а готовые ответы доставляются через deliver(chat_id, text).
+    """
+
+    def __init__(self, claude_client, deliver, poll_interval=60.0):
+        self.claude_client = claude_client
+        self.deliver = deliver
+        self.poll_interval = poll_interval
+        self.running = set()
+
+    async def run(self, name, jobs):
+        """Выполняет задание: jobs — список (custom_id, [chat_id, ...], request).
+
+        Возвращает число доставленных и неудачных ответов.
+        """
+        if not jobs:
+            return 0, 0
+        if name in self.running:
+            raise RuntimeError(f"Задание {name} уже выполняется")
+        self.running.add(name)
+        try:
+            batch = await self.claude_client.messages.batches.create(requests=[
+                {"custom_id": custom_id, "params": request} for custom_id, _, request in jobs
+            ])
+            logger.info(f"Задание {name}: отправлен пакет {batch.id} из {len(jobs)} запросов")
+            await self.wait(batch.id)
+            recipients = {custom_id: chat_ids for custom_id, chat_ids, _ in jobs}
+            delivered = failed = 0
+            async for entry in await self.claude_client.messages.batches.results(batch.id):
+                chat_ids = recipients.get(entry.custom_id, [])
+                if entry.result.type != "succeeded":
+                    logger.warning(f"Задание {name}: запрос {entry.custom_id} завершился с {entry.result.type}")
+                    failed += len(chat_ids)
+                    continue
+                text = entry.result.message.content[0].text
+                for chat_id in chat_ids:
+                    try:
+                        await self.deliver(chat_id, text)
+                        delivered += 1
+                    except Exception as e:
+                        logger.warning(f"Задание {name}: не удалось доставить ответ в чат {chat_id}: {e}")
+                        failed += 1
+            logger.info(f"Задание {name}: доставлено {delivered}, с ошибками {failed}")
+            return delivered, failed
+        finally:
+            self.running.discard(name)
+
+    async def wait(self, batch_id):
+        """Опрашивает пакет, пока его обработка не закончится"""
+        while True:
+            batch = await self.claude_client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                return batch
+            await asyncio.sleep(self.poll_interval)
+
+
+class FailedRequestBacklog:
+    """Сообщения, на которые не удалось ответить (например, во время сбоя Claude)"""
+
+    def __init__(self, max_size=1000):
+        self.items = deque(maxlen=max_size)
+
+    def add(self, chat_id, user_id, text):
+        self.items.append((chat_id, user_id, text))
+
+    def drain(self):
+        items = list(self.items)
+        self.items.clear()
+        return items
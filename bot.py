@@ -1,7 +1,8 @@
 import os
+import time
+import datetime
 import logging
 import asyncio
-import tempfile
 from pathlib import Path
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
@@ -9,10 +10,30 @@ from aiogram.filters import CommandStart, Command
 from anthropic import AsyncAnthropic
 from dotenv import load_dotenv
 import speech_recognition as sr
-from pydub import AudioSegment
-import pytesseract
-from PIL import Image
 import io
+from streaming import stream_claude_text
+from delivery import ReplyDelivery
+from telegram_html import escape, render_markdown
+from prompt_cache import build_system_blocks, build_cached_messages, log_usage
+from context_window import trim_history, split_summary, with_summary
+from context_store import SQLiteContextStore
+from summarizer import Summarizer
+from user_locks import UserLocks
+from debounce import MessageDebouncer, burst_key, burst_text
+from inflight import InflightRequests, RequestCancelled
+from limiter import AdaptiveLimiter
+from token_governor import TokenGovernor
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
+from answer_cache import AnswerCache
+from singleflight import SingleFlight, request_fingerprint
+from router import ModelRouter, classify_request, max_tokens_for
+from config import CLAUDE_MODEL, CLAUDE_FAST_MODEL
+from batch_jobs import BatchJobRunner, FailedRequestBacklog, make_custom_id
+from webhook import WebhookServer
+from outbound import OutboundQueue, OutboundMiddleware
+from dispatch import ChatDispatcher
+from voice import VoiceTranscriber, VoiceQueueFull
+from ocr import OcrPool, OcrQueueFull
 
 # Загрузка переменных окружения из файла .env
 load_dotenv()
@@ -38,8 +59,21 @@ if not CLAUDE_API_KEY:
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
 
-# Инициализация клиента Claude
-claude_client = AsyncAnthropic(api_key=CLAUDE_API_KEY)
+# Все запросы бота к чатам идут через общую очередь с лимитами Telegram
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # сообщений в секунду
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # сообщений в секунду на чат
+outbound_queue = OutboundQueue(global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE)
+bot.session.middleware(OutboundMiddleware(outbound_queue))
+
+# Обновления одного чата обрабатываются по порядку, число обработчиков ограничено
+MAX_HANDLERS_IN_FLIGHT = int(os.getenv("MAX_HANDLERS_IN_FLIGHT", "64"))
+MAX_QUEUED_UPDATES = int(os.getenv("MAX_QUEUED_UPDATES", "1000"))
+chat_dispatcher = ChatDispatcher(max_in_flight=MAX_HANDLERS_IN_FLIGHT, max_queued=MAX_QUEUED_UPDATES)
+dp.update.outer_middleware(chat_dispatcher)
+
+# Инициализация клиента Claude. Повторы при 429/529 делает общий ограничитель
+# (claude_limiter), поэтому собственные повторы клиента отключены
+claude_client = AsyncAnthropic(api_key=CLAUDE_API_KEY, max_retries=0)
 
 # Системная инструкция с ролью для Claude
 SYSTEM_PROMPT = """
@@ -101,25 +135,147 @@ SYSTEM_PROMPT = """
 8. Пропонуй практичні поради, які можна застосувати в реальному житті.
 """
 
-# Максимальная длина контекста для сохранения истории сообщений
-MAX_CONTEXT_LENGTH = 10
-user_contexts = {}
-
-# Настройка пути к исполняемому файлу Tesseract (для Windows)
-pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+# Бюджет входных токенов на историю сообщений (без системной инструкции)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+# Старые длинные сообщения (распознанный текст и т.п.) сокращаются до этого размера
+CONTEXT_MAX_MESSAGE_TOKENS = 800
+
+# Хранилище истории сообщений: SQLite с кэшем в памяти и отложенной записью
+CONTEXT_DB_PATH = os.getenv("CONTEXT_DB_PATH", "contexts.sqlite3")
+# Размер кэша в памяти: активные пользователи, остальные подгружаются с диска
+CONTEXT_CACHE_MAX_USERS = int(os.getenv("CONTEXT_CACHE_MAX_USERS", "1000"))
+CONTEXT_CACHE_IDLE_TTL = 3600  # секунд без обращений до вытеснения из памяти
+context_store = SQLiteContextStore(
+    CONTEXT_DB_PATH, max_cached_users=CONTEXT_CACHE_MAX_USERS, idle_ttl=CONTEXT_CACHE_IDLE_TTL
+)
+
+# Потоковая выдача ответа: сообщение с ответом обновляется по мере генерации
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+# Правки сообщения объединяются, чтобы не упираться в лимиты Telegram
+STREAM_EDIT_INTERVAL = 1.0  # секунд между правками
+STREAM_EDIT_MIN_CHARS = 40  # новых символов для очередной правки
+
+# Общий адаптивный ограничитель параллельных запросов к Claude
+CLAUDE_MAX_CONCURRENCY = int(os.getenv("CLAUDE_MAX_CONCURRENCY", "32"))
+claude_limiter = AdaptiveLimiter(initial_limit=4, max_limit=CLAUDE_MAX_CONCURRENCY)
+
+# Лимиты аккаунта Anthropic на токены в минуту (вход и выход)
+CLAUDE_INPUT_TOKENS_PER_MINUTE = int(os.getenv("CLAUDE_INPUT_TOKENS_PER_MINUTE", "40000"))
+CLAUDE_OUTPUT_TOKENS_PER_MINUTE = int(os.getenv("CLAUDE_OUTPUT_TOKENS_PER_MINUTE", "16000"))
+token_governor = TokenGovernor(CLAUDE_INPUT_TOKENS_PER_MINUTE, CLAUDE_OUTPUT_TOKENS_PER_MINUTE)
+
+# Повторы временных ошибок, дублирующие запросы и предохранитель на время сбоев Claude
+CLAUDE_HEDGE = os.getenv("CLAUDE_HEDGE", "0") == "1"
+claude_caller = ResilientCaller(
+    CircuitBreaker(failure_threshold=5, reset_timeout=30.0), max_attempts=3, hedge=CLAUDE_HEDGE
+)
+# Ответ пользователю, пока предохранитель разомкнут
+SERVICE_UNAVAILABLE_TEXT = (
+    "Вибачте, зараз я не можу відповісти: сервіс тимчасово недоступний. "
+    "Спробуйте, будь ласка, за кілька хвилин."
+)
+
+# Кэш ответов на повторяющиеся вопросы, заданные в начале разговора
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2000"))
+ANSWER_CACHE_TTL = 24 * 3600  # секунд
+answer_cache = AnswerCache(max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+
+# Одинаковые одновременные запросы к Claude выполняются один раз
+claude_single_flight = SingleFlight()
+
+# Выбор модели: простые запросы — быстрой модели, сложные — основной (см. config.py)
+ROUTER_FAST_MAX_CHARS = int(os.getenv("ROUTER_FAST_MAX_CHARS", "200"))
+ROUTER_FAST_MAX_DEPTH = int(os.getenv("ROUTER_FAST_MAX_DEPTH", "6"))  # пар реплик
+model_router = ModelRouter(
+    CLAUDE_FAST_MODEL, CLAUDE_MODEL,
+    fast_max_chars=ROUTER_FAST_MAX_CHARS, fast_max_depth=ROUTER_FAST_MAX_DEPTH
+)
+
+# Если ответ уперся в max_tokens, модель просят продолжить (не больше раз)
+MAX_CONTINUATIONS = 2
+CONTINUATION_MAX_TOKENS = 1000
+
+# Массовые неинтерактивные задания идут через Message Batches API отдельным клиентом;
+# CLAUDE_BATCH_BASE_URL позволяет направить их на локальную заглушку API
+batch_claude_client = AsyncAnthropic(api_key=CLAUDE_API_KEY, base_url=os.getenv("CLAUDE_BATCH_BASE_URL") or None)
+BATCH_POLL_INTERVAL = 60  # секунд между проверками готовности пакета
+BATCH_MAX_TOKENS = 1200
+# Пользователи, которым доступны команды массовых заданий
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x.strip()}
+# Сообщения, оставшиеся без ответа (например, во время сбоя), для повторной обработки пакетом
+failed_backlog = FailedRequestBacklog()
+batch_tasks = set()
+
+# Способ получения обновлений: polling (по умолчанию) или webhook.
+# В режиме webhook несколько копий бота могут работать за одним прокси
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # внешний адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # символы A-Z, a-z, 0-9, _ и -
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    logger.error("Для режима webhook нужны WEBHOOK_URL и WEBHOOK_SECRET!")
+    raise ValueError("WEBHOOK_URL и WEBHOOK_SECRET обязательны в режиме webhook")
+
+# Распознавание голосовых сообщений: отдельный пул потоков и ограниченная очередь
+VOICE_WORKERS = int(os.getenv("VOICE_WORKERS", "2"))
+VOICE_MAX_QUEUED = int(os.getenv("VOICE_MAX_QUEUED", "20"))
+voice_transcriber = VoiceTranscriber(workers=VOICE_WORKERS, max_queued=VOICE_MAX_QUEUED)
+
+# Распознавание текста на фото: пул процессов (по умолчанию по числу ядер)
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "0")) or None
+OCR_MAX_QUEUED = int(os.getenv("OCR_MAX_QUEUED", "50"))
+# Путь к исполняемому файлу Tesseract и его языковым моделям (для Windows);
+# передаются процессам пула явно
+TESSERACT_CMD = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+TESSDATA_PATH = r'C:\Program Files\Tesseract-OCR\tessdata'
+ocr_pool = OcrPool(
+    workers=OCR_WORKERS, max_queued=OCR_MAX_QUEUED, lang="rus+eng",
+    tesseract_cmd=TESSERACT_CMD, tessdata=TESSDATA_PATH if os.path.isdir(TESSDATA_PATH) else None
+)
+
+# Как часто писать в лог метрики ограничителей (секунд)
+METRICS_LOG_INTERVAL = 300
+
+# Старые реплики не отбрасываются, а сворачиваются дешевой моделью в сводку
+SUMMARY_MODEL = CLAUDE_FAST_MODEL
+SUMMARY_MAX_TOKENS = 400
+
+# Сообщения, отправленные подряд в течение окна (секунд), объединяются в одну реплику
+DEBOUNCE_WINDOW = float(os.getenv("DEBOUNCE_WINDOW", "1.5"))
+debouncer = MessageDebouncer(DEBOUNCE_WINDOW)
+
+# Запросы к Claude можно отменить: /clear, тайм-аут (секунд, 0 — без ограничения)
+# и, если включено, новое сообщение пользователя
+CLAUDE_REQUEST_TIMEOUT = float(os.getenv("CLAUDE_REQUEST_TIMEOUT", "120")) or None
+CANCEL_SUPERSEDED = os.getenv("CANCEL_SUPERSEDED", "0") == "1"
+inflight = InflightRequests(timeout=CLAUDE_REQUEST_TIMEOUT, cancel_superseded=CANCEL_SUPERSEDED)
+
+# Сообщения одного пользователя обрабатываются строго по очереди
+user_locks = UserLocks()
+# send_claude_request объявлена ниже, поэтому передаем ее через lambda
+summarizer = Summarizer(
+    lambda request: send_claude_request(request, hedge=False), context_store, SUMMARY_MODEL,
+    max_tokens=SUMMARY_MAX_TOKENS, user_locks=user_locks
+)
+
+# Команды тоже проходят через очередь пользователя: ответ на них не обгоняет
+# ответы на сообщения, отправленные раньше
 
 @dp.message(CommandStart())
 async def send_welcome(message: types.Message):
     """Обработчик команды /start"""
-    user_id = message.from_user.id
-    user_contexts[user_id] = []
-    
-    await message.answer(
+    forget_pending(message)
+    await reset_history(
+        message,
         "Привіт! Я універсальний помічник-консультант з багатьох питань: "
         "від медицини, садівництва, кулінарії та різних життєвих питань."
     )
 
 @dp.message(Command("help"))
+@user_locks.serialized
 async def send_help(message: types.Message):
     """Обработчик команды /help"""
     help_text = """
@@ -127,197 +283,434 @@ async def send_help(message: types.Message):
     """
     await message.answer(help_text)
 
+@dp.message(Command("batch_backlog"), F.from_user.id.in_(ADMIN_USER_IDS))
+@user_locks.serialized
+async def batch_backlog(message: types.Message):
+    """Повторная обработка сообщений, оставшихся без ответа (для администраторов)"""
+    start_batch_job(message, "backlog", backlog_jobs)
+    await message.answer("Завдання запущено.")
+
+@dp.message(Command("batch_digest"), F.from_user.id.in_(ADMIN_USER_IDS))
+@user_locks.serialized
+async def batch_digest(message: types.Message):
+    """Рассылка сезонных советов (для администраторов)"""
+    start_batch_job(message, "digest", digest_jobs)
+    await message.answer("Завдання запущено.")
+
 @dp.message(Command("clear"))
 async def clear_history(message: types.Message):
     """Очистка"""
+    # Ответы на сообщения, отправленные до очистки, не должны попасть в очищенную историю.
+    # Отменяем их сразу, а очищаем, когда отмененные обработчики освободят очередь
+    forget_pending(message)
+    await reset_history(message, "Історія очищена!")
+
+@user_locks.serialized
+async def reset_history(message, reply):
+    """Очищает историю в порядке очереди пользователя и отвечает reply"""
     user_id = message.from_user.id
-    user_contexts[user_id] = []
-    await message.answer("Історія очищена!")
-
-async def process_text_with_claude(user_id, text_content):
-    """Обробка тексту"""
-    # Создаем контекст пользователя, если его еще нет
-    if user_id not in user_contexts:
-        user_contexts[user_id] = []
+    # Сводку мог запланировать обработчик, завершившийся уже после forget_pending
+    summarizer.cancel(user_id)
+    await context_store.clear(user_id)
+    await message.answer(reply)
+
+def forget_pending(message):
+    """Отменяет все, что готовится по сообщениям пользователя до очистки истории:
+    серию в окне объединения, обработчики в очереди, запрос к Claude и сводку
+    """
+    debouncer.drop(burst_key(message))
+    inflight.clear(message.from_user.id)
+    summarizer.cancel(message.from_user.id)
+
+async def deliver_batch_answer(chat_id, text):
+    """Доставка ответа массового задания; лимиты Telegram соблюдает очередь отправки"""
+    await ReplyDelivery(bot, chat_id).finish(render_markdown(text), parse_mode=ParseMode.HTML)
+
+batch_runner = BatchJobRunner(batch_claude_client, deliver_batch_answer, poll_interval=BATCH_POLL_INTERVAL)
+
+def build_batch_request(text, summary=None):
+    """Запрос для пакетной обработки: без истории, с системной инструкцией"""
+    return dict(
+        model=CLAUDE_MODEL,
+        max_tokens=BATCH_MAX_TOKENS,
+        system=build_system_blocks(SYSTEM_PROMPT, summary),
+        messages=[{"role": "user", "content": text}]
+    )
+
+def current_season():
+    month = datetime.date.today().month
+    return ("зиму", "весну", "літо", "осінь")[month % 12 // 3]
+
+async def backlog_jobs():
+    """Повторные ответы на сообщения, оставшиеся без ответа"""
+    jobs = []
+    for n, (chat_id, user_id, text) in enumerate(failed_backlog.drain()):
+        request = build_batch_request(text)
+        jobs.append((make_custom_id("backlog", chat_id, n), [chat_id], request))
+    return jobs
+
+async def digest_jobs():
+    """Сезонные поради всем пользователям; без сводки разговора — один общий запрос"""
+    question = (
+        f"Дай, будь ласка, кілька корисних сезонних порад на {current_season()}: "
+        "для городу і саду, для кухні та для здоров'я."
+    )
+    generic_chats = []
+    jobs = []
+    for user_id, summary in (await context_store.summaries()).items():
+        if summary:
+            jobs.append((make_custom_id("digest", user_id), [user_id], build_batch_request(question, summary)))
+        else:
+            generic_chats.append(user_id)
+    if generic_chats:
+        jobs.append((make_custom_id("digest", "all"), generic_chats, build_batch_request(question)))
+    return jobs
+
+async def run_batch_job(message, name, build_jobs):
+    """Запуск массового задания в фоне с отчетом администратору"""
+    try:
+        delivered, failed = await batch_runner.run(name, await build_jobs())
+        await message.answer(f"Завдання {name} виконано: доставлено {delivered}, помилок {failed}.")
+    except Exception as e:
+        logging.error(f"Ошибка массового задания {name}: {e}")
+        await message.answer(f"Завдання {name} завершилося з помилкою.")
+
+def start_batch_job(message, name, build_jobs):
+    task = asyncio.create_task(run_batch_job(message, name, build_jobs))
+    batch_tasks.add(task)
+    task.add_done_callback(batch_tasks.discard)
+
+async def send_claude_request(request, on_update=None, hedge=True):
+    """Запрос к Claude через общие ограничители; on_update включает потоковый режим
+
+    Одинаковые одновременные запросы (например, пересланное многим
+    пользователям сообщение) объединяются в один.
+    """
+    return await claude_single_flight.run(
+        request_fingerprint(request),
+        lambda fanout: call_claude(request, fanout, hedge),
+        on_update
+    )
+
+async def call_claude(request, on_update=None, hedge=True):
+    """Запрос к Claude с повторами и ограничителями
+
+    Временные ошибки повторяются, при сбоях Claude срабатывает предохранитель.
+    Каждая попытка ждет токены в минутных лимитах, затем место среди
+    параллельных запросов. Дублирующий запрос отправляется из уже занятого
+    места и только пока в ограничителе нет очереди; потоковые запросы
+    не дублируются.
+    """
+    if on_update is not None:
+        call = lambda: stream_claude_text(claude_client, on_update, **request)
+    else:
+        create = lambda: claude_client.messages.create(**request)
+        call = lambda: claude_caller.hedge_call(
+            create, enabled=hedge and not claude_limiter.stats()["queued"]
+        )
+    attempt = lambda: token_governor.run(request, lambda: claude_limiter.run(call))
+    return await claude_caller.run(attempt)
+
+async def log_metrics():
+    """Периодически пишет в лог состояние ограничителей запросов к Claude"""
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        logger.info(f"Ограничитель Claude: {claude_limiter.stats()}")
+        logger.info(f"Лимиты токенов Claude: {token_governor.stats()}")
+        logger.info(f"Надежность запросов к Claude: {claude_caller.stats()}")
+        logger.info(f"Кэш ответов: {answer_cache.stats()}")
+        logger.info(f"Объединено одинаковых запросов к Claude: {claude_single_flight.shared}")
+        logger.info(f"Маршруты моделей: {model_router.stats()}")
+        logger.info(f"Очередь отправки в Telegram: {outbound_queue.stats()}")
+        logger.info(f"Очереди обновлений по чатам: {chat_dispatcher.stats()}")
+        logger.info(f"Распознавание голоса: {voice_transcriber.stats()}")
+        logger.info(f"Распознавание текста на фото: {ocr_pool.stats()}")
+
+async def save_history(user_id, messages):
+    """Сохраняет сообщения, не затирая сводку, обновленную в фоне
     
-    # Добавляем сообщение пользователя в контекст
-    user_contexts[user_id].append({"role": "user", "content": text_content})
+    Если история очищена после прихода сообщения, ничего не сохраняет
+    (RequestCancelled).
+    """
+    summary, _ = split_summary(await context_store.get(user_id))
+    inflight.check(user_id)
+    await context_store.set(user_id, with_summary(summary, messages))
+
+async def ask_claude(user_id, route, request, on_update=None):
+    """Один запрос к Claude с учетом метрик маршрута (его можно отменить, см. inflight)"""
+    started = time.monotonic()
+    response = await inflight.run(user_id, send_claude_request(request, on_update))
+    model_router.record(route, request["model"], time.monotonic() - started, response.usage)
+    log_usage(user_id, response.usage)
+    return response
+
+async def process_text_with_claude(user_id, text_content, on_update=None, source="text"):
+    """Обробка тексту
+
+    Если передан on_update, ответ запрашивается в потоковом режиме
+    и on_update вызывается с накопленным текстом. source ("text", "voice",
+    "photo") учитывается при выборе модели.
+    """
+    # Получаем контекст пользователя (пустой, если его еще нет) и сводку старых реплик
+    summary, history = split_summary(await context_store.get(user_id))
+    # История очищена, пока сообщение ждало очереди или распознавалось
+    inflight.check(user_id)
     
-    # Ограничиваем длину контекста
-    if len(user_contexts[user_id]) > MAX_CONTEXT_LENGTH:
-        user_contexts[user_id] = user_contexts[user_id][-MAX_CONTEXT_LENGTH:]
+    # Вопрос без контекста разговора может уже быть в кэше ответов
+    first_turn = not history and not summary
+    if first_turn:
+        cached_response = answer_cache.get(text_content)
+        if cached_response is not None:
+            await save_history(user_id, [
+                {"role": "user", "content": text_content},
+                {"role": "assistant", "content": cached_response},
+            ])
+            return cached_response
     
-    # Подготавливаем сообщения для отправки в Claude
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + user_contexts[user_id]
+    # Выбираем модель и лимит длины ответа по признакам запроса
+    request_class = classify_request(text_content, source)
+    route, model = model_router.choose(text_content, history, request_class)
     
-    # Отправляем запрос к Claude
-    response = await claude_client.messages.create(
-        model="claude-3-7-sonnet-20250219",
-        max_tokens=1500,
-        messages=messages
+    # Добавляем сообщение пользователя в контекст
+    history.append({"role": "user", "content": text_content})
+    
+    # Ограничиваем контекст бюджетом токенов
+    history, dropped = trim_history(history, CONTEXT_TOKEN_BUDGET, max_message_tokens=CONTEXT_MAX_MESSAGE_TOKENS)
+    
+    # Подготавливаем сообщения для отправки в Claude: системная инструкция
+    # и префикс истории помечены для кэширования промпта
+    request = dict(
+        model=model,
+        max_tokens=max_tokens_for(request_class),
+        system=build_system_blocks(SYSTEM_PROMPT, summary),
+        messages=build_cached_messages(history)
     )
     
-    # Получаем ответ от Claude
+    # Отправляем запрос к Claude и получаем ответ
+    response = await ask_claude(user_id, route, request, on_update)
     claude_response = response.content[0].text
     
-    # Добавляем ответ Claude в контекст
-    user_contexts[user_id].append({"role": "assistant", "content": claude_response})
+    # Ответ оборвался на лимите длины — просим модель продолжить с того же места
+    continuations = 0
+    while response.stop_reason == "max_tokens" and continuations < MAX_CONTINUATIONS:
+        continuations += 1
+        # Текст-затравка ассистента не может заканчиваться пробелами
+        claude_response = claude_response.rstrip()
+        request = dict(
+            request,
+            max_tokens=CONTINUATION_MAX_TOKENS,
+            messages=build_cached_messages(history + [{"role": "assistant", "content": claude_response}])
+        )
+        continue_update = None
+        if on_update is not None:
+            continue_update = lambda text, prefix=claude_response: on_update(prefix + text)
+        response = await ask_claude(user_id, route, request, continue_update)
+        claude_response += response.content[0].text
+    
+    # Полный ответ на вопрос без контекста сохраняем для повторных вопросов
+    if first_turn and response.stop_reason == "end_turn":
+        answer_cache.put(text_content, claude_response)
+    
+    # Добавляем реплику и ответ Claude в контекст только после успешного ответа,
+    # чтобы отмененный или неудачный запрос не оставлял следов в истории
+    history.append({"role": "assistant", "content": claude_response})
+    await save_history(user_id, history)
+    # Вышедшие за бюджет реплики сворачиваются в сводку в фоне
+    summarizer.schedule(user_id, dropped)
     
     return claude_response
 
+def new_delivery(chat_id, max_actions=2):
+    """Доставка ответа в чат; индикатор "печатает..." включается сразу
+    и отправляется не больше max_actions раз
+    """
+    delivery = ReplyDelivery(
+        bot, chat_id, max_actions=max_actions,
+        edit_interval=STREAM_EDIT_INTERVAL, edit_min_chars=STREAM_EDIT_MIN_CHARS
+    )
+    delivery.start()
+    return delivery
+
 @dp.message(F.text)
 async def process_text_message(message: types.Message):
     """Обработка текстовых сообщений"""
+    # Сообщения, отправленные подряд, объединяются в одну реплику
+    burst = debouncer.join(message)
+    if burst is None:
+        return
+    try:
+        await answer_text_message(message, burst)
+    finally:
+        # Обработчик отменен раньше, чем серия закрылась: новые сообщения начнут новую
+        debouncer.discard(burst_key(message), burst)
+
+@inflight.superseding
+@user_locks.serialized
+async def answer_text_message(message, burst):
+    """Ответ на серию текстовых сообщений"""
     user_id = message.from_user.id
-    user_message = message.text
+    # Место в очереди пользователя уже занято — ждем, пока серия закончится
+    burst = await debouncer.settle(burst_key(message), burst)
+    # История очищена, пока серия собиралась, — отвечать не на что
+    if inflight.stale(user_id):
+        debouncer.done(burst_key(message), burst)
+        return
+    user_message = burst_text(burst)
     
-    # Создаем ждущее сообщение
-    waiting_msg = await message.answer("Думаю...")
+    # Пока ответ готовится, в чате видно "печатает..."
+    delivery = new_delivery(message.chat.id)
     
     try:
-        # Обрабатываем текст с помощью Claude
-        claude_response = await process_text_with_claude(user_id, user_message)
+        if STREAM_REPLIES:
+            # Показываем ответ по мере генерации
+            claude_response = await process_text_with_claude(user_id, user_message, on_update=delivery.update)
+        else:
+            # Обрабатываем текст с помощью Claude
+            claude_response = await process_text_with_claude(user_id, user_message)
         
-        # Удаляем сообщение "Думаю..."
-        await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
+        # Ответ уже в истории — новые сообщения его больше не отменяют
+        debouncer.done(burst_key(message), burst)
         
         # Отправляем ответ пользователю
-        await message.answer(claude_response, parse_mode=ParseMode.MARKDOWN)
+        await delivery.finish(render_markdown(claude_response), parse_mode=ParseMode.HTML)
         
+    except asyncio.CancelledError:
+        # Пользователь дописал сообщение — ответ будет дан на всю серию
+        await delivery.cancel()
+        raise
+    except RequestCancelled:
+        await delivery.cancel()
+    except CircuitOpenError:
+        await delivery.fail(SERVICE_UNAVAILABLE_TEXT)
+        failed_backlog.add(message.chat.id, user_id, user_message)
     except Exception as e:
         logging.error(f"Ошибка при обработке текстового сообщения: {e}")
-        await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
-        await message.answer(f"Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже.")
+        await delivery.fail(f"Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже.")
+        failed_backlog.add(message.chat.id, user_id, user_message)
+    finally:
+        debouncer.done(burst_key(message), burst)
 
 @dp.message(F.voice)
+@inflight.superseding
+@user_locks.serialized
 async def process_voice_message(message: types.Message):
     """Обработка голосовых сообщений"""
     user_id = message.from_user.id
     
-    # Создаем ждущее сообщение
-    waiting_msg = await message.answer("Распознаю голосовое сообщение...")
+    # Ответ не потоковый: индикатор показываем один раз, не расходуя лимит чата
+    delivery = new_delivery(message.chat.id, max_actions=1)
     
     try:
-        # Получаем файл голосового сообщения
+        # Загружаем голосовое сообщение в память
         voice = await bot.get_file(message.voice.file_id)
-        voice_path = voice.file_path
-        
-        # Создаем временный файл для сохранения голосового сообщения
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as voice_file:
-            voice_file_path = voice_file.name
-        
-        # Загружаем голосовое сообщение
-        await bot.download_file(voice_path, destination=voice_file_path)
-        
-        # Конвертируем из OGG в WAV для распознавания
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as wav_file:
-            wav_file_path = wav_file.name
+        voice_data = await bot.download_file(voice.file_path)
         
-        # Используем pydub для конвертации
-        audio = AudioSegment.from_ogg(voice_file_path)
-        audio.export(wav_file_path, format="wav")
-        
-        # Используем speech_recognition для распознавания
-        recognizer = sr.Recognizer()
-        with sr.AudioFile(wav_file_path) as source:
-            audio_data = recognizer.record(source)
-            # Пытаемся распознать речь на русском языке
-            text = recognizer.recognize_google(audio_data, language="ru-RU")
-        
-        # Удаляем временные файлы
-        os.unlink(voice_file_path)
-        os.unlink(wav_file_path)
-        
-        # Обновляем статус
-        await bot.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=waiting_msg.message_id,
-            text=f"Розпізнаний текст: {text}\n\nТеперь аналізую..."
-        )
+        # Конвертация и распознавание идут в отдельном пуле потоков
+        text = await voice_transcriber.transcribe(voice_data.getvalue())
         
         # Обрабатываем распознанный текст с помощью Claude
-        claude_response = await process_text_with_claude(user_id, text)
-        
-        # Удаляем сообщение "Анализирую..."
-        await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
+        claude_response = await process_text_with_claude(user_id, text, source="voice")
         
         # Отправляем ответ пользователю
-        await message.answer(
-            f"Розпізнаний текст: <b>{text}</b>\n\n{claude_response}", 
+        await delivery.finish(
+            f"Розпізнаний текст: <b>{escape(text)}</b>\n\n{render_markdown(claude_response)}",
             parse_mode=ParseMode.HTML
         )
         
+    except asyncio.CancelledError:
+        await delivery.cancel()
+        raise
+    except RequestCancelled:
+        await delivery.cancel()
+    except CircuitOpenError:
+        await delivery.fail(SERVICE_UNAVAILABLE_TEXT)
+        failed_backlog.add(message.chat.id, user_id, text)
+    except VoiceQueueFull:
+        await delivery.fail("Зараз багато голосових повідомлень. Спробуйте, будь ласка, за хвилину.")
     except sr.UnknownValueError:
-        await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
-        await message.answer("Помилка. Спробуєте пізніше.")
+        await delivery.fail("Помилка. Спробуєте пізніше.")
     except sr.RequestError as e:
-        await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
-        await message.answer(f"Ошибка сервиса распознавания речи: {e}")
+        await delivery.fail(f"Ошибка сервиса распознавания речи: {e}")
     except Exception as e:
         logging.error(f"Помилка {e}")
-        await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
-        await message.answer(f"Помилка. Спробуєте пізніше.")
+        await delivery.fail(f"Помилка. Спробуєте пізніше.")
 
 @dp.message(F.photo)
+@inflight.superseding
+@user_locks.serialized
 async def process_photo_message(message: types.Message):
     """Обробка зображення"""
     user_id = message.from_user.id
     
-    # Создаем ждущее сообщение
-    waiting_msg = await message.answer("Разпізнаю зображення...")
+    # Ответ не потоковый: индикатор показываем один раз, не расходуя лимит чата
+    delivery = new_delivery(message.chat.id, max_actions=1)
     
     try:
-        # Получаем файл изображения (берем самое высокое качество)
+        # Загружаем изображение в память (берем самое высокое качество)
         photo = await bot.get_file(message.photo[-1].file_id)
-        photo_path = photo.file_path
-        
-        # Создаем временный файл для сохранения изображения
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as photo_file:
-            photo_file_path = photo_file.name
+        photo_data = await bot.download_file(photo.file_path)
         
-        # Загружаем изображение
-        await bot.download_file(photo_path, destination=photo_file_path)
-        
-        # Используем pytesseract для распознавания текста на изображении
-        image = Image.open(photo_file_path)
-        text = pytesseract.image_to_string(image, lang='rus+eng')
-        
-        # Удаляем временный файл
-        os.unlink(photo_file_path)
+        # Распознавание идет в пуле процессов с заранее загруженными моделями Tesseract
+        text = await ocr_pool.recognize(photo_data.getvalue())
         
         # Если текст не распознан
         if not text or text.isspace():
-            await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
-            await message.answer("Помилка.")
+            await delivery.fail("Помилка.")
             return
         
-        # Обновляем статус
-        await bot.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=waiting_msg.message_id,
-            text=f"Роспізнаний текст: {text}\n\nТепер аналізую..."
-        )
-        
         # Обрабатываем распознанный текст с помощью Claude
-        claude_response = await process_text_with_claude(user_id, text)
-        
-        # Удаляем сообщение "Анализирую..."
-        await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
+        claude_response = await process_text_with_claude(user_id, text, source="photo")
         
         # Отправляем ответ пользователю
-        await message.answer(
-            f"Роспізнаний текст: <b>{text}</b>\n\n{claude_response}", 
+        await delivery.finish(
+            f"Роспізнаний текст: <b>{escape(text)}</b>\n\n{render_markdown(claude_response)}",
             parse_mode=ParseMode.HTML
         )
         
+    except asyncio.CancelledError:
+        await delivery.cancel()
+        raise
+    except RequestCancelled:
+        await delivery.cancel()
+    except CircuitOpenError:
+        await delivery.fail(SERVICE_UNAVAILABLE_TEXT)
+        failed_backlog.add(message.chat.id, user_id, text)
+    except OcrQueueFull:
+        await delivery.fail("Зараз багато зображень. Спробуйте, будь ласка, за хвилину.")
     except Exception as e:
         logging.error(f"Помилка зображення: {e}")
-        await bot.delete_message(chat_id=message.chat.id, message_id=waiting_msg.message_id)
-        await message.answer(f"Помилка при обробці тексту.")
+        await delivery.fail(f"Помилка при обробці тексту.")
 
 async def main():
-    # Запуск бота
-    await dp.start_polling(bot)
+    await ocr_pool.start()
+    await context_store.start()
+    metrics_task = asyncio.create_task(log_metrics())
+    try:
+        # Запуск бота
+        if BOT_MODE == "webhook":
+            # Задачи на обновления создает chat_dispatcher: ответ Telegram уходит,
+            # как только обновление встало в очередь
+            await WebhookServer(
+                dp, bot, WEBHOOK_URL, WEBHOOK_SECRET,
+                path=WEBHOOK_PATH, host=WEBHOOK_HOST, port=WEBHOOK_PORT
+            ).run()
+        else:
+            # Long polling не работает, пока зарегистрирован вебхук
+            await bot.delete_webhook()
+            # Задачи на обновления создает chat_dispatcher, очередь ограничена.
+            # Сессию закрываем сами, когда начатые обработчики закончат
+            await dp.start_polling(bot, handle_as_tasks=False, close_bot_session=False)
+    finally:
+        metrics_task.cancel()
+        await chat_dispatcher.close()
+        await summarizer.close()
+        await outbound_queue.close()
+        voice_transcriber.close()
+        ocr_pool.close()
+        # Сбрасываем несохраненную историю на диск
+        await context_store.close()
+        # Последним: до этого обработчики и очередь отправки еще пользуются сессией
+        await bot.session.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,137 @@
+import re
+from streaming import TELEGRAM_MESSAGE_LIMIT
+
+# Места разреза по убыванию предпочтения: абзац, пункт списка, строка, предложение, пробел
+_BOUNDARIES = (
+    re.compile(r"\n\s*\n"),
+    re.compile(r"\n(?=[ \t]*(?:[-*•]|\d+[.)])\s)"),
+    re.compile(r"\n"),
+    re.compile(r"(?<=[.!?…])\s+"),
+    re.compile(r"\s+"),
+)
+# Куски короче этой доли лимита режутся по следующему, менее удобному месту
+_MIN_FILL = 0.5
+
+_HTML_TAG = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>")
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT, parse_mode=None):
+    """Делит текст на сообщения не длиннее limit.
+
+    Текст режется по абзацам, пунктам списков и строкам, в крайнем случае
+    по словам. Разрез не попадает внутрь HTML-тега, сущности или
+    Markdown-ссылки; разметка, открытая на месте разреза, закрывается
+    в конце куска и открывается заново в начале следующего.
+    """
+    chunks = []
+    reopen = ""
+    while True:
+        body = reopen + text
+        if len(body) <= limit:
+            chunks.append(body)
+            return chunks
+        max_len = limit
+        while True:
+            cut, skip = _find_cut(body, max_len, parse_mode)
+            stack = _open_entities(body[:cut], parse_mode)
+            close = _closing(stack, parse_mode)
+            if cut + len(close) <= limit or max_len <= len(reopen) + 1:
+                break
+            max_len = limit - len(close)
+        chunks.append(body[:cut].rstrip(" ") + close)
+        reopen = _opening(stack, parse_mode)
+        text = body[cut + skip:]
+
+
+def _find_cut(body, max_len, parse_mode):
+    """Позиция разреза и длина отбрасываемого разделителя"""
+    min_len = int(max_len * _MIN_FILL)
+    for boundary in _BOUNDARIES:
+        # Ближайший к лимиту разделитель, на котором можно резать
+        for match in reversed(list(boundary.finditer(body, min_len, max_len + 1))):
+            if _safe_cut(body[:match.start()], parse_mode):
+                return match.start(), len(match.group())
+    # Подходящего разделителя нет — режем посреди слова, но не посреди разметки
+    cut = max_len
+    while cut > min_len and not _safe_cut(body[:cut], parse_mode):
+        cut -= 1
+    return cut, 0
+
+
+def _safe_cut(prefix, parse_mode):
+    """Разрез после prefix не ломает тег, HTML-сущность или ссылку"""
+    if parse_mode == "HTML":
+        if prefix.rfind("<") > prefix.rfind(">"):
+            return False
+        amp = prefix.rfind("&")
+        return amp == -1 or ";" in prefix[amp:] or len(prefix) - amp > 10
+    if parse_mode == "Markdown":
+        return not _markdown_state(prefix)[1]
+    return True
+
+
+def _open_entities(prefix, parse_mode):
+    """Разметка, открытая в конце prefix (стек открывающих тегов или маркеров)"""
+    if parse_mode == "HTML":
+        stack = []
+        for match in _HTML_TAG.finditer(prefix):
+            name = match.group(2).lower()
+            if not match.group(1):
+                stack.append((name, match.group()))
+                continue
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == name:
+                    del stack[i:]
+                    break
+        return stack
+    if parse_mode == "Markdown":
+        return _markdown_state(prefix)[0]
+    return []
+
+
+def _markdown_state(text):
+    """Открытые маркеры Markdown и признак незакрытой ссылки"""
+    stack = []
+    in_link = False
+    i = 0
+    while i < len(text):
+        top = stack[-1] if stack else None
+        if text.startswith("```", i):
+            if top == "```":
+                stack.pop()
+            elif top is None:
+                stack.append("```")
+            i += 3
+            continue
+        c = text[i]
+        if top == "```" or (top == "`" and c != "`"):
+            i += 1
+            continue
+        if c == "\\":
+            i += 2
+            continue
+        if c == "`" or (c in "*_" and top in (None, c)):
+            if top == c:
+                stack.pop()
+            else:
+                stack.append(c)
+        elif c == "[" and not in_link:
+            in_link = True
+        elif c == ")" and in_link:
+            in_link = False
+        elif c == "]" and in_link and not text.startswith("](", i):
+            in_link = False
+        i += 1
+    return stack, in_link
+
+
+def _closing(stack, parse_mode):
+    if parse_mode == "HTML":
+        return "".join(f"</{name}>" for name, _ in reversed(stack))
+    return "".join("\n```" if m == "```" else m for m in reversed(stack))
+
+
+def _opening(stack, parse_mode):
+    if parse_mode == "HTML":
+        return "".join(tag for _, tag in stack)
+    return "".join("```\n" if m == "```" else m for m in stack)
@@ -10,6 +10,7 @@ CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
 
 # Настройки бота
 CLAUDE_MODEL = "claude-3-7-sonnet-20250219"  # Модель Claude
+CLAUDE_FAST_MODEL = "claude-3-5-haiku-20241022"  # Быстрая модель для простых запросов
 MAX_TOKENS = 1500  # Максимальное количество токенов в ответе
 MAX_CONTEXT_LENGTH = 10  # Максимальное количество сообщений в истории
 
@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from context_window import split_summary
+
+logger = logging.getLogger(__name__)
+
+
+def current_rss_bytes():
+    """Текущий объем резидентной памяти процесса (None, если узнать нельзя)"""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if sys.platform == "win32":
+        return _windows_rss_bytes()
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        # Например, macOS без psutil: ru_maxrss — пиковое значение, а не текущее
+        return None
+
+
+def _windows_rss_bytes():
+    """Рабочий набор процесса через GetProcessMemoryInfo (без psutil)"""
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    try:
+        kernel32 = ctypes.WinDLL("kernel32")
+        psapi = ctypes.WinDLL("psapi")
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        psapi.GetProcessMemoryInfo.argtypes = [
+            wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD
+        ]
+        psapi.GetProcessMemoryInfo.restype = wintypes.BOOL
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return None
+        return counters.WorkingSetSize
+    except (OSError, AttributeError):
+        return None
+
+
+class ContextStore:
+    """Интерфейс хранилища истории сообщений пользователей"""
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get(self, user_id):
+        """Возвращает копию истории пользователя (пустой список, если её нет)"""
+        raise NotImplementedError
+
+    async def set(self, user_id, messages):
+        raise NotImplementedError
+
+    async def clear(self, user_id):
+        await self.set(user_id, [])
+
+    async def summaries(self):
+        """Пользователи с сохраненной историей: user_id -> сводка разговора (или None).
+
+        Для массовых заданий: кэш недавних пользователей не затрагивается.
+        """
+        raise NotImplementedError
+
+
+class MemoryContextStore(ContextStore):
+    """Хранение истории только в памяти процесса"""
+
+    def __init__(self):
+        self.contexts = {}
+
+    async def get(self, user_id):
+        return list(self.contexts.get(user_id, []))
+
+    async def set(self, user_id, messages):
+        self.contexts[user_id] = list(messages)
+
+    async def summaries(self):
+        return {
+            user_id: split_summary(messages)[0]
+            for user_id, messages in self.contexts.items() if messages
+        }
+
+
+class SQLiteContextStore(ContextStore):
+    """История в SQLite (WAL) с горячим кэшем в памяти и отложенной записью.
+
+    Чтение идёт из кэша, промахи и запись выполняются в отдельном потоке,
+    поэтому цикл событий не блокируется. Изменения копятся и сбрасываются
+    на диск пачкой раз в flush_interval секунд или при накоплении batch_size.
+
+    Кэш ограничен: не больше max_cached_users пользователей (LRU), а истории,
+    к которым не обращались дольше idle_ttl секунд, вытесняются. На диске
+    истории хранятся сжатыми zlib и подгружаются при возвращении пользователя.
+    """
+
+    def __init__(self, path, flush_interval=2.0, batch_size=100,
+                 max_cached_users=1000, idle_ttl=3600.0, stats_interval=300.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_cached_users = max_cached_users
+        self.idle_ttl = idle_ttl
+        self.stats_interval = stats_interval
+        # user_id -> (время последнего обращения, история), порядок LRU
+        self.cache = OrderedDict()
+        # Изменения, еще не записанные на диск: user_id -> история
+        self.dirty = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = None
+        # Одно соединение используется только из одного потока
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-store")
+        self._flush_event = asyncio.Event()
+        self._flush_task = None
+
+    async def start(self):
+        await self._run(self._open)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    async def get(self, user_id):
+        entry = self.cache.get(user_id)
+        if entry is not None:
+            self.hits += 1
+            messages = entry[1]
+        else:
+            self.misses += 1
+            # Вытесненная, но еще не записанная история берется из очереди записи
+            messages = self.dirty.get(user_id)
+            if messages is None:
+                messages = await self._run(self._load, user_id)
+            # Пока шло чтение, история могла быть записана заново
+            entry = self.cache.get(user_id)
+            if entry is not None:
+                messages = entry[1]
+        self._touch(user_id, messages)
+        return list(messages)
+
+    async def set(self, user_id, messages):
+        messages = list(messages)
+        self._touch(user_id, messages)
+        self.dirty[user_id] = messages
+        if len(self.dirty) >= self.batch_size:
+            self._flush_event.set()
+
+    async def summaries(self):
+        # Читаем прямо с диска, чтобы не вытеснить из кэша активных пользователей
+        await self.flush()
+        return await self._run(self._summaries)
+
+    async def flush(self):
+        """Записывает накопленные изменения на диск одной транзакцией"""
+        if not self.dirty:
+            return
+        # Списки в очереди не изменяются на месте, поэтому их можно сериализовать в другом потоке
+        batch = self.dirty
+        self.dirty = {}
+        try:
+            await self._run(self._write, list(batch.items()))
+        except Exception as e:
+            logger.error(f"Ошибка записи истории в {self.path}: {e}")
+            # Вернём изменения в очередь для следующей попытки, не затирая более новые
+            for user_id, messages in batch.items():
+                self.dirty.setdefault(user_id, messages)
+
+    def evict_idle(self):
+        """Вытесняет из кэша истории, к которым давно не обращались"""
+        deadline = time.monotonic() - self.idle_ttl
+        while self.cache:
+            user_id, (last_access, _) = next(iter(self.cache.items()))
+            if last_access > deadline:
+                break
+            del self.cache[user_id]
+            self.evictions += 1
+
+    def stats(self):
+        """Счетчики кэша для подбора его размера"""
+        total = self.hits + self.misses
+        return {
+            "cached_users": len(self.cache),
+            "dirty_users": len(self.dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "rss_bytes": current_rss_bytes(),
+        }
+
+    def encode(self, messages):
+        return zlib.compress(json.dumps(messages, ensure_ascii=False).encode("utf-8"))
+
+    def decode(self, data):
+        # Записи, сохраненные до включения сжатия, хранятся как JSON
+        if isinstance(data, str) or data[:1] == b"[":
+            return json.loads(data)
+        return json.loads(zlib.decompress(data))
+
+    def _touch(self, user_id, messages):
+        self.cache[user_id] = (time.monotonic(), messages)
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.max_cached_users:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    async def _flush_loop(self):
+        last_stats = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            self.evict_idle()
+            await self.flush()
+            if time.monotonic() - last_stats >= self.stats_interval:
+                last_stats = time.monotonic()
+                logger.info(f"Кэш истории: {self.stats()}")
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS contexts ("
+            "user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _load(self, user_id):
+        row = self._conn.execute("SELECT data FROM contexts WHERE user_id = ?", (user_id,)).fetchone()
+        return self.decode(row[0]) if row else []
+
+    def _summaries(self):
+        # Пустая история сжатым JSON занимает несколько байт, поэтому фильтруем после чтения
+        summaries = {}
+        for user_id, data in self._conn.execute("SELECT user_id, data FROM contexts"):
+            messages = self.decode(data)
+            if messages:
+                summaries[user_id] = split_summary(messages)[0]
+        return summaries
+
+    def _write(self, batch):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO contexts (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                [(user_id, self.encode(messages), now) for user_id, messages in batch],
+            )
@@ -0,0 +1,110 @@
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Роль записи со сводкой старых реплик; хранится первой в истории и в Claude не отправляется
+SUMMARY_ROLE = "summary"
+
+
+def estimate_tokens(text):
+    """Быстрая локальная оценка числа токенов.
+
+    Латиница занимает около 4 байт UTF-8 на токен, кириллица — 2 символа
+    по 2 байта, поэтому деление длины в байтах на 4 подходит для обоих случаев.
+    """
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def message_tokens(message):
+    """Оценка токенов одного сообщения истории"""
+    content = message["content"]
+    if isinstance(content, str):
+        return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    return sum(estimate_tokens(block.get("text", "")) for block in content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def history_tokens(history):
+    return sum(message_tokens(m) for m in history)
+
+
+def compact_text(text, max_tokens):
+    """Обрезает слишком длинный текст, оставляя начало и конец"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # Оценка консервативная: на токен не больше 4 байт, т.е. не меньше 2 символов кириллицы
+    keep = max(max_tokens * 2, 16)
+    head = text[:keep // 2]
+    tail = text[-(keep // 2):]
+    return f"{head}\n[...]\n{tail}"
+
+
+def normalize_history(history):
+    """Приводит историю к чередованию user/assistant, начиная с user.
+
+    Подряд идущие сообщения одной роли склеиваются (например, после
+    неудачного запроса, когда ответ ассистента не был сохранён).
+    """
+    result = []
+    for message in history:
+        if not result and message["role"] != "user":
+            continue
+        if result and result[-1]["role"] == message["role"]:
+            result[-1] = {
+                "role": message["role"],
+                "content": f"{result[-1]['content']}\n\n{message['content']}",
+            }
+        else:
+            result.append(dict(message))
+    return result
+
+
+def split_summary(history):
+    """Разделяет сохраненную историю на сводку (или None) и сами сообщения"""
+    if history and history[0]["role"] == SUMMARY_ROLE:
+        return history[0]["content"], history[1:]
+    return None, list(history)
+
+
+def with_summary(summary, messages):
+    """Собирает историю для хранения из сводки и сообщений"""
+    if not summary:
+        return list(messages)
+    return [{"role": SUMMARY_ROLE, "content": summary}] + list(messages)
+
+
+def trim_history(history, budget, max_message_tokens=None, low_watermark=0.75):
+    """Подгоняет историю под бюджет входных токенов.
+
+    Старые длинные сообщения (например, распознанный текст) сокращаются
+    до max_message_tokens, затем отбрасываются самые старые пары реплик.
+    При превышении бюджета история урезается до low_watermark от него,
+    чтобы префикс оставался стабильным несколько ходов и читался из кэша.
+    Последнее сообщение пользователя сохраняется всегда.
+
+    Возвращает оставшуюся историю и список отброшенных сообщений.
+    """
+    history = normalize_history(history)
+    if history_tokens(history) <= budget:
+        return history, []
+
+    if max_message_tokens:
+        history = [
+            m if i == len(history) - 1 or not isinstance(m["content"], str)
+            else {"role": m["role"], "content": compact_text(m["content"], max_message_tokens)}
+            for i, m in enumerate(history)
+        ]
+
+    target = int(budget * low_watermark)
+    total = history_tokens(history)
+    start = 0
+    # Удаляем по паре user/assistant, чтобы история начиналась с user
+    while total > target and start + 2 < len(history):
+        total -= message_tokens(history[start]) + message_tokens(history[start + 1])
+        start += 2
+    dropped = history[:start]
+    history = history[start:]
+
+    # Даже одно последнее сообщение не должно выходить за бюджет
+    last = history[-1]
+    if total > budget and isinstance(last["content"], str):
+        allowed = budget - (total - message_tokens(last)) - MESSAGE_OVERHEAD_TOKENS
+        history[-1] = {"role": last["role"], "content": compact_text(last["content"], allowed)}
+    return history, dropped
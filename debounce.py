@@ -0,0 +1,96 @@
+import time
+import logging
+import asyncio
+
+logger = logging.getLogger(__name__)
+
+
+class _Burst:
+    def __init__(self):
+        self.messages = []
+        self.updated = time.monotonic()
+
+
+class MessageDebouncer:
+    """Объединение серии сообщений, отправленных подряд, в одну реплику.
+
+    Серии ведутся отдельно для каждого пользователя в каждом чате (в группе
+    сообщения разных людей не смешиваются). На серию отвечает обработчик
+    первого сообщения: он ждёт, пока от пользователя не будет новых
+    сообщений window секунд, а сообщения, пришедшие за это время,
+    просто добавляются в серию. Если серия уже обрабатывается,
+    а пользователь дописал текст, обработка отменяется и её сообщения
+    переходят в новую серию.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # (chat_id, user_id) -> серия, в которую еще добавляются сообщения
+        self.bursts = {}
+        # (chat_id, user_id) -> (задача, серия), ответ на которую еще не получен
+        self.active = {}
+        self.merged = 0
+        self.cancelled = 0
+
+    def join(self, message):
+        """Добавляет сообщение в серию его автора в этом чате.
+
+        Возвращает новую серию, если на неё должен ответить этот обработчик
+        (после settle), иначе None.
+        """
+        key = burst_key(message)
+        burst = self.bursts.get(key)
+        if burst is not None:
+            self.merged += 1
+            burst.messages.append(message)
+            burst.updated = time.monotonic()
+            return None
+        burst = self.bursts[key] = _Burst()
+        active = self.active.pop(key, None)
+        if active is not None:
+            task, messages = active
+            task.cancel()
+            self.cancelled += 1
+            burst.messages.extend(messages)
+        burst.messages.append(message)
+        return burst
+
+    async def settle(self, key, burst):
+        """Ждет конца серии и возвращает ее сообщения; key — см. burst_key"""
+        while True:
+            delay = burst.updated + self.window - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if self.bursts.get(key) is burst:
+            del self.bursts[key]
+        self.active[key] = (asyncio.current_task(), burst.messages)
+        if len(burst.messages) > 1:
+            logger.info(f"Объединено {len(burst.messages)} сообщений в чате {key[0]}")
+        return burst.messages
+
+    def discard(self, key, burst):
+        """Серия не будет обработана (обработчик отменен до settle)"""
+        if self.bursts.get(key) is burst:
+            del self.bursts[key]
+
+    def drop(self, key):
+        """Забывает незакрытую и обрабатываемую серии (история очищена)"""
+        self.bursts.pop(key, None)
+        self.active.pop(key, None)
+
+    def done(self, key, messages):
+        """Ответ на серию получен — новые сообщения его больше не отменяют"""
+        active = self.active.get(key)
+        if active is not None and active[1] is messages:
+            del self.active[key]
+
+
+def burst_key(message):
+    """Серии ведутся по автору в чате: (chat_id, user_id)"""
+    return message.chat.id, message.from_user.id
+
+
+def burst_text(burst):
+    """Текст серии сообщений как одна реплика пользователя"""
+    return "\n".join(message.text for message in burst)
@@ -0,0 +1,131 @@
+import time
+import logging
+import asyncio
+from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramBadRequest
+from outbound import final_delivery
+from streaming import StreamingEditor, TELEGRAM_MESSAGE_LIMIT
+from chunking import split_message
+from telegram_html import html_to_text
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyDelivery:
+    """Доставка ответа на одно сообщение пользователя.
+
+    Пока ответ готовится, в чате показывается "печатает..." (индикатор
+    обновляется в фоне, но отправляется не больше max_actions раз: каждый
+    запрос расходует лимит сообщений чата). Потоковый ответ отправляется одним сообщением,
+    которое затем правится до окончательного текста; готовый ответ
+    отправляется сразу. Длинный ответ делится на части (см. split_message):
+    первая заменяет начатое сообщение, остальные ставятся в очередь
+    отправки все сразу и уходят по порядку.
+    """
+
+    def __init__(self, bot, chat_id, action=ChatAction.TYPING, action_interval=4.5,
+                 max_actions=2, edit_interval=1.0, edit_min_chars=40):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.action = action
+        # Telegram показывает индикатор около 5 секунд
+        self.action_interval = action_interval
+        self.max_actions = max_actions
+        self.edit_interval = edit_interval
+        self.edit_min_chars = edit_min_chars
+        self.editor = None
+        # Отправка первого фрагмента, пока ее результат еще не обработан
+        self._first_send = None
+        self.started_at = time.monotonic()
+        self._typing = None
+
+    def start(self):
+        """Включает индикатор "печатает..." до появления ответа"""
+        if self._typing is None:
+            self._typing = asyncio.create_task(self._typing_loop())
+
+    async def update(self, text):
+        """Показывает накопленный текст потокового ответа"""
+        if self.editor is not None:
+            await self.editor.update(text)
+            return
+        if len(text) < self.edit_min_chars:
+            return
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        self._stop_typing()
+        # Очередь отправки доставит сообщение, даже если обработчик отменят, пока оно
+        # в пути; задача сохраняется, чтобы cancel() могла его удалить
+        self._first_send = asyncio.ensure_future(self.bot.send_message(self.chat_id, text))
+        sent = await asyncio.shield(self._first_send)
+        self._first_send = None
+        self.editor = StreamingEditor(
+            self.bot, self.chat_id, sent.message_id,
+            min_interval=self.edit_interval, min_chars=self.edit_min_chars, shown_text=text
+        )
+        logger.info(f"Первый фрагмент ответа показан через {time.monotonic() - self.started_at:.2f} с")
+
+    async def finish(self, text, parse_mode=None):
+        """Показывает окончательный ответ"""
+        self._stop_typing()
+        chunks = split_message(text, parse_mode=parse_mode)
+        if self.editor is not None:
+            await self.editor.finish(chunks.pop(0), parse_mode=parse_mode)
+        await self._send(chunks, parse_mode)
+
+    async def fail(self, text):
+        """Показывает сообщение об ошибке вместо ответа"""
+        self._stop_typing()
+        if self.editor is not None and await self.editor.finish(text):
+            return
+        await self._send([text])
+
+    async def cancel(self):
+        """Убирает начатый ответ: на сообщение ответят заново или не ответят вовсе"""
+        self._stop_typing()
+        await self._delete()
+
+    async def _send(self, chunks, parse_mode=None):
+        """Отправляет части ответа, не дожидаясь доставки каждой по отдельности"""
+        with final_delivery():
+            results = await asyncio.gather(
+                *(self.bot.send_message(self.chat_id, chunk, parse_mode=parse_mode) for chunk in chunks),
+                return_exceptions=True,
+            )
+            for chunk, result in zip(chunks, results):
+                if not isinstance(result, Exception):
+                    continue
+                if parse_mode is None or not isinstance(result, TelegramBadRequest):
+                    raise result
+                # Разметка не прошла проверку Telegram — отправляем эту часть без нее
+                logger.warning(f"Не удалось применить разметку к ответу: {result}")
+                await self.bot.send_message(self.chat_id, html_to_text(chunk) if parse_mode == "HTML" else chunk)
+
+    async def _delete(self):
+        if self.editor is not None:
+            message_id, self.editor = self.editor.message_id, None
+        elif self._first_send is not None:
+            # Обработчик отменен, пока первый фрагмент был в пути
+            send, self._first_send = self._first_send, None
+            try:
+                message_id = (await asyncio.shield(send)).message_id
+            except Exception:
+                return
+        else:
+            return
+        with final_delivery():
+            await self.bot.delete_message(chat_id=self.chat_id, message_id=message_id)
+
+    def _stop_typing(self):
+        if self._typing is not None:
+            self._typing.cancel()
+            self._typing = None
+
+    async def _typing_loop(self):
+        for sent in range(self.max_actions):
+            if sent:
+                await asyncio.sleep(self.action_interval)
+            try:
+                await self.bot.send_chat_action(self.chat_id, self.action)
+            except Exception as e:
+                logger.warning(f"Не удалось показать индикатор набора: {e}")
+                return
@@ -0,0 +1,162 @@
+import time
+import logging
+import asyncio
+import contextvars
+from collections import deque
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Место текущего обработчика в ChatDispatcher (см. release_chat)
+_admission = contextvars.ContextVar("chat_admission", default=None)
+
+
+def _current_admission():
+    # Задачи, созданные обработчиком, наследуют контекст, но не его место
+    admission = _admission.get()
+    if admission is not None and admission.task is asyncio.current_task():
+        return admission
+    return None
+
+
+def release_chat():
+    """Обработчик занял свое место в очереди (например, ждет блокировку пользователя):
+    следующее обновление чата можно начинать, порядок ответов сохранится.
+    Пока обработчик ждет, он не занимает место среди выполняющихся.
+    """
+    admission = _current_admission()
+    if admission is not None:
+        admission.release()
+
+
+async def resume_chat():
+    """Обработчик дождался своей очереди и продолжает работу: снова занимает
+    место среди выполняющихся (см. release_chat)
+    """
+    admission = _current_admission()
+    if admission is not None:
+        await admission.resume()
+
+
+class _Admission:
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.task = None
+        self.admitted = asyncio.Event()
+        self.has_slot = True
+
+    def release(self):
+        self.admitted.set()
+        if self.has_slot:
+            self.has_slot = False
+            self.dispatcher._release_slot()
+
+    async def resume(self):
+        if not self.has_slot:
+            await self.dispatcher._acquire_slot()
+            self.has_slot = True
+
+
+class _Chat:
+    def __init__(self):
+        self.updates = deque()
+        self.runner = None
+
+
+class ChatDispatcher(BaseMiddleware):
+    """Упорядоченная обработка обновлений по чатам (внешний middleware для dp.update).
+
+    Обновления одного чата начинают обрабатываться строго по очереди:
+    следующее — когда предыдущий обработчик закончил или вызвал
+    release_chat(). Одновременно выполняется не больше max_in_flight
+    обработчиков (ожидающие после release_chat не считаются), а в очередях
+    ждет не больше max_queued обновлений; при переполнении прием новых
+    обновлений приостанавливается.
+    """
+
+    def __init__(self, max_in_flight=64, max_queued=1000):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.chats = {}
+        self.queued = 0
+        self.in_flight = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._queue_space = asyncio.Semaphore(max_queued)
+        self._tasks = set()
+        self.max_depth = 0
+        self.backpressure = 0
+        self.wait_time = 0.0
+        self.admitted = 0
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is None:
+            return await handler(event, data)
+        if self._queue_space.locked():
+            self.backpressure += 1
+        await self._queue_space.acquire()
+        entry = self.chats.get(chat.id)
+        if entry is None:
+            entry = self.chats[chat.id] = _Chat()
+        entry.updates.append((handler, event, data, time.monotonic()))
+        self.queued += 1
+        self.max_depth = max(self.max_depth, len(entry.updates))
+        if entry.runner is None:
+            entry.runner = self._spawn(self._run_chat(chat.id, entry))
+
+    async def close(self, timeout=10.0):
+        """Дает начатым обработчикам до timeout секунд, затем отменяет оставшиеся"""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "chats": len(self.chats),
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "max_depth": self.max_depth,
+            "backpressure": self.backpressure,
+            "avg_wait": round(self.wait_time / self.admitted, 3) if self.admitted else 0.0,
+        }
+
+    async def _run_chat(self, chat_id, entry):
+        try:
+            while entry.updates:
+                handler, event, data, queued_at = entry.updates[0]
+                await self._acquire_slot()
+                entry.updates.popleft()
+                self.queued -= 1
+                self._queue_space.release()
+                self.admitted += 1
+                self.wait_time += time.monotonic() - queued_at
+                admission = _Admission(self)
+                admission.task = self._spawn(self._handle(handler, event, data, admission))
+                await admission.admitted.wait()
+        finally:
+            del self.chats[chat_id]
+
+    async def _handle(self, handler, event, data, admission):
+        _admission.set(admission)
+        try:
+            await handler(event, data)
+        except Exception:
+            logger.exception(f"Ошибка при обработке обновления {event.update_id}")
+        finally:
+            admission.release()
+
+    async def _acquire_slot(self):
+        await self._slots.acquire()
+        self.in_flight += 1
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
@@ -0,0 +1,99 @@
+import logging
+import asyncio
+import functools
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# Номер очистки истории, действовавший, когда пришло обрабатываемое сообщение
+_epoch = contextvars.ContextVar("clear_epoch", default=None)
+
+
+class RequestCancelled(Exception):
+    """Запрос к Claude отменен (очистка истории или более новое сообщение)"""
+
+
+class InflightRequests:
+    """Учёт выполняющихся запросов к Claude по пользователям.
+
+    Запрос можно отменить по /clear или при новом сообщении пользователя
+    (если включено cancel_superseded), а также по тайм-ауту. Отмененный
+    запрос ничего не пишет в историю: она сохраняется только после ответа.
+
+    Очистка истории (clear) к тому же отменяет ответы на все сообщения,
+    пришедшие до нее, даже если до запроса к Claude они еще не дошли
+    (ждут очереди пользователя, распознаются и т.п.): см. check.
+    """
+
+    def __init__(self, timeout=None, cancel_superseded=False):
+        self.timeout = timeout
+        self.cancel_superseded = cancel_superseded
+        self.tasks = {}
+        # user_id -> число очисток истории
+        self.epochs = {}
+        self._cancelled = set()
+        self.cancelled = 0
+        self.timed_out = 0
+
+    async def run(self, user_id, coro):
+        """Выполняет запрос как отменяемую задачу пользователя"""
+        task = asyncio.create_task(coro)
+        self.tasks[user_id] = task
+        try:
+            return await asyncio.wait_for(task, self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            logger.warning(f"Запрос пользователя {user_id} не уложился в {self.timeout} с")
+            raise
+        except asyncio.CancelledError:
+            if task in self._cancelled:
+                raise RequestCancelled() from None
+            raise
+        finally:
+            self._cancelled.discard(task)
+            if self.tasks.get(user_id) is task:
+                del self.tasks[user_id]
+
+    def cancel(self, user_id):
+        """Отменяет выполняющийся запрос пользователя, если он есть"""
+        task = self.tasks.pop(user_id, None)
+        if task is None or task.done():
+            return False
+        self._cancelled.add(task)
+        task.cancel()
+        self.cancelled += 1
+        logger.info(f"Запрос пользователя {user_id} отменен")
+        return True
+
+    def clear(self, user_id):
+        """История пользователя очищается: ответы на прежние сообщения не нужны"""
+        self.epochs[user_id] = self.epochs.get(user_id, 0) + 1
+        self.cancel(user_id)
+
+    def stale(self, user_id):
+        """История очищена после прихода текущего сообщения"""
+        epoch = _epoch.get()
+        return epoch is not None and epoch != self.epochs.get(user_id, 0)
+
+    def check(self, user_id):
+        """RequestCancelled, если ответ на текущее сообщение уже не нужен (см. stale)"""
+        if self.stale(user_id):
+            raise RequestCancelled()
+
+    def supersede(self, user_id):
+        """Новое сообщение пользователя отменяет прежний запрос, если так настроено"""
+        if self.cancel_superseded:
+            self.cancel(user_id)
+
+    def superseding(self, handler):
+        """Декоратор обработчика сообщений: новое сообщение отменяет прежний запрос.
+
+        Запоминает и номер очистки истории на момент прихода сообщения (см. check).
+        """
+        @functools.wraps(handler)
+        async def wrapper(message, *args):
+            user_id = message.from_user.id
+            _epoch.set(self.epochs.get(user_id, 0))
+            self.supersede(user_id)
+            return await handler(message, *args)
+        return wrapper
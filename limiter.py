@@ -0,0 +1,151 @@
+import time
+import logging
+import asyncio
+from collections import deque
+import anthropic
+
+logger = logging.getLogger(__name__)
+
+# Типы ошибок в теле ответа, означающие перегрузку (в том числе посреди потока)
+OVERLOAD_ERROR_TYPES = ("rate_limit_error", "overloaded_error")
+
+
+def is_overload_error(e):
+    """429/529 и аналогичные ошибки, пришедшие в потоке событий"""
+    if not isinstance(e, anthropic.APIStatusError):
+        return False
+    if e.status_code in (429, 529):
+        return True
+    if isinstance(e.body, dict):
+        return e.body.get("error", {}).get("type") in OVERLOAD_ERROR_TYPES
+    return False
+
+
+def retry_after_seconds(e):
+    """Значение заголовка retry-after в секундах (None, если его нет)"""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """Общий адаптивный ограничитель параллельных запросов к Claude (AIMD).
+
+    Пока запросы отвечают быстрее target_latency, лимит растет примерно
+    на единицу за каждые limit успешных ответов; при 429/529 лимит
+    уменьшается вдвое, а новые запросы ждут retry-after. Запросы сверх
+    лимита и получившие 429/529 не падают, а ждут в очереди (до max_retries
+    повторов).
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=32,
+                 target_latency=30.0, decrease_factor=0.5, max_retries=5):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._waiters = deque()
+        self.rate_limited = 0
+        self.completed = 0
+
+    async def run(self, call):
+        """Выполняет call() (функцию, возвращающую корутину) под ограничителем"""
+        attempt = 0
+        while True:
+            await self.acquire()
+            started = time.monotonic()
+            try:
+                result = await call()
+            except Exception as e:
+                if not is_overload_error(e):
+                    self.release()
+                    raise
+                self.release(overloaded=True, retry_after=retry_after_seconds(e))
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning(f"Claude перегружен ({e.__class__.__name__}), запрос снова в очереди")
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release(latency=time.monotonic() - started)
+            return result
+
+    async def acquire(self):
+        # Очередь FIFO: новый запрос не обгоняет уже ждущих
+        if self._waiters or not self._has_capacity():
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                while True:
+                    await waiter
+                    if self._waiters and self._waiters[0] is waiter and self._has_capacity():
+                        break
+                    waiter = self._rewait(waiter)
+            except BaseException:
+                self._remove_waiter(waiter)
+                self._wake()
+                raise
+            self._waiters.popleft()
+        self.in_flight += 1
+        self._wake()
+        # После 429/529 новые запросы выжидают retry-after, занимая свое место
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                self.release()
+                raise
+
+    def release(self, latency=None, overloaded=False, retry_after=None):
+        self.in_flight -= 1
+        if overloaded:
+            self.rate_limited += 1
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            logger.info(f"Лимит параллельных запросов к Claude снижен до {self.limit:.1f}")
+        elif latency is not None:
+            self.completed += 1
+            if latency <= self.target_latency:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "rate_limited": self.rate_limited,
+            "completed": self.completed,
+        }
+
+    def _has_capacity(self):
+        return self.in_flight < int(self.limit)
+
+    def _wake(self):
+        # Будим первого в очереди; он сам проверит, есть ли место
+        if self._waiters and not self._waiters[0].done():
+            self._waiters[0].set_result(None)
+
+    def _rewait(self, waiter):
+        index = self._waiters.index(waiter)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[index] = waiter
+        return waiter
+
+    def _remove_waiter(self, waiter):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
@@ -0,0 +1,163 @@
+import io
+import os
+import time
+import logging
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+import pytesseract
+
+logger = logging.getLogger(__name__)
+
+# Модель Tesseract, загруженная в процессе пула (None — используется pytesseract)
+_api = None
+_lang = None
+
+
+class OcrQueueFull(Exception):
+    """Слишком много изображений ждут распознавания"""
+
+
+def _init_worker(lang, tesseract_cmd=None, tessdata=None):
+    """Загружает языковые модели один раз на процесс.
+
+    Пути к Tesseract передаются явно: при запуске процессов через spawn
+    (Windows) настройки родительского процесса в них не попадают.
+    """
+    global _api, _lang
+    _lang = lang
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    try:
+        import tesserocr
+        if tessdata:
+            _api = tesserocr.PyTessBaseAPI(path=tessdata, lang=lang)
+        else:
+            _api = tesserocr.PyTessBaseAPI(lang=lang)
+    except Exception as e:
+        # Без tesserocr каждый вызов запускает отдельный процесс tesseract
+        logger.warning(f"tesserocr недоступен, используется pytesseract: {e}")
+
+
+def _ping():
+    return os.getpid()
+
+
+def recognize_image(data):
+    """Текст на изображении (байты); выполняется в процессе пула"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        if _api is None:
+            return pytesseract.image_to_string(image, lang=_lang)
+        _api.SetImage(image)
+        try:
+            return _api.GetUTF8Text()
+        finally:
+            _api.Clear()
+    except Exception as e:
+        # Исключения pytesseract не переносятся между процессами и ломают пул
+        raise RuntimeError(f"{e.__class__.__name__}: {e}") from None
+
+
+class OcrPool:
+    """Распознавание текста на изображениях в пуле долгоживущих процессов.
+
+    Каждый процесс загружает модели Tesseract (через tesserocr, если он
+    установлен) один раз при старте, поэтому распознавание не блокирует
+    цикл событий и масштабируется по числу ядер. Ждать очереди могут
+    не больше max_queued изображений, остальным сразу отказывается
+    (OcrQueueFull). tesseract_cmd — путь к исполняемому файлу tesseract
+    (для pytesseract), tessdata — каталог языковых моделей (для tesserocr).
+    """
+
+    def __init__(self, workers=None, max_queued=50, lang="rus+eng", tesseract_cmd=None, tessdata=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queued = max_queued
+        self.lang = lang
+        self.tesseract_cmd = tesseract_cmd
+        self.tessdata = tessdata
+        self.executor = None
+        self._slots = asyncio.Semaphore(self.workers)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.work_time = 0.0
+
+    async def start(self):
+        """Запускает процессы заранее, чтобы первое фото не ждало загрузки моделей"""
+        self.executor = self._create_executor()
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(
+            loop.run_in_executor(self.executor, _ping) for _ in range(self.workers)
+        ))
+        logger.info(f"Пул распознавания текста запущен: {len(set(pids))} процессов")
+
+    async def recognize(self, data):
+        """Текст на изображении (байты файла)"""
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise OcrQueueFull()
+        queued_at = time.monotonic()
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        started = time.monotonic()
+        self.wait_time += started - queued_at
+        self.running += 1
+        executor = self.executor
+        try:
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(executor, recognize_image, data)
+        except BrokenProcessPool:
+            # Процесс пула аварийно завершился — следующие фото обработает новый пул
+            self.failed += 1
+            if self.executor is executor:
+                logger.error("Пул распознавания текста сломан, создаем заново")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._create_executor()
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.running -= 1
+            self.work_time += time.monotonic() - started
+            self._slots.release()
+        self.completed += 1
+        return text
+
+    def _create_executor(self):
+        # fork (где он есть): дочерним процессам не нужно заново импортировать модуль бота.
+        # При spawn (Windows) каждый процесс пула при старте заново выполняет bot.py
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.lang, self.tesseract_cmd, self.tessdata),
+        )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        done = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait": round(self.wait_time / done, 2) if done else 0.0,
+            "avg_time": round(self.work_time / done, 2) if done else 0.0,
+        }
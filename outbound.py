@@ -0,0 +1,276 @@
+import time
+import logging
+import asyncio
+import itertools
+import contextvars
+from contextlib import contextmanager
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import DeleteMessage, EditMessageText, SendChatAction
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов: меньшее значение отправляется раньше
+PRIORITY_FINAL = 0  # ответы пользователю, удаление заглушек
+PRIORITY_STATUS = 1  # промежуточные правки, "печатает..."
+
+_priority = contextvars.ContextVar("outbound_priority", default=None)
+
+
+@contextmanager
+def final_delivery():
+    """Запросы внутри блока отправляются как окончательный ответ"""
+    token = _priority.set(PRIORITY_FINAL)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class RateBucket:
+    """Ведро токенов: rate запросов в секунду, не больше burst подряд"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = float(burst)
+        self.level = float(burst)
+        self.updated = time.monotonic()
+
+    def ready_at(self, now=None):
+        """Момент, когда в ведре будет целый токен"""
+        now = time.monotonic() if now is None else now
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.level >= 1:
+            return now
+        return now + (1 - self.level) / self.rate
+
+    def take(self):
+        self.ready_at()
+        self.level -= 1
+
+
+class _Item:
+    def __init__(self, seq, priority, chat_id, key, call):
+        self.seq = seq
+        self.priority = priority
+        self.chat_id = chat_id
+        self.key = key
+        self.call = call
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """Общая очередь исходящих запросов к Telegram.
+
+    Соблюдает общий лимит (около 30 сообщений в секунду) и лимит на чат
+    (около одного в секунду), выдерживает паузу retry_after после
+    TelegramRetryAfter и повторяет запрос. Запросы одного чата уходят
+    по одному. Ожидающая правка сообщения заменяется более новой правкой
+    того же сообщения, а удаление сообщения отменяет его правки.
+    Окончательные ответы отправляются раньше промежуточных.
+    """
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, chat_burst=3, max_retries=3,
+                 max_tracked_chats=10000):
+        self.global_bucket = RateBucket(global_rate, burst=global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_tracked_chats = max_tracked_chats
+        self.chat_buckets = {}
+        self.blocked_until = {}
+        self.busy_chats = set()
+        self.items = []
+        self.edits = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+        self.sent = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+
+    async def submit(self, chat_id, call, priority=PRIORITY_FINAL, edit_key=None, delete_key=None):
+        """Ставит call() в очередь и возвращает его результат.
+
+        edit_key — (chat_id, message_id) правки, delete_key — удаляемого сообщения.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+        if delete_key is not None:
+            self._drop_edits(delete_key)
+        item = _Item(next(self._seq), priority, chat_id, edit_key, call)
+        if edit_key is not None:
+            previous = self.edits.get(edit_key)
+            if previous is not None:
+                # Старая правка больше не нужна: ее ждущий получит результат новой
+                self.items.remove(previous)
+                item.priority = min(item.priority, previous.priority)
+                item.seq = previous.seq
+                self._chain(previous, item)
+                self.coalesced += 1
+            self.edits[edit_key] = item
+        self.items.append(item)
+        self._wakeup.set()
+        # Отмена ожидающего не отменяет запрос: его результат может ждать замененная правка
+        return await asyncio.shield(item.future)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for item in self.items:
+            item.future.cancel()
+        self.items.clear()
+        self.edits.clear()
+
+    def stats(self):
+        return {
+            "queued": len(self.items),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "flood_waits": self.flood_waits,
+        }
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            item, wake = self._next_item()
+            if item is None:
+                timeout = None if wake is None else max(0.0, wake - time.monotonic())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.items.remove(item)
+            if item.key is not None and self.edits.get(item.key) is item:
+                del self.edits[item.key]
+            self.global_bucket.take()
+            self._chat_bucket(item.chat_id).take()
+            self.busy_chats.add(item.chat_id)
+            task = asyncio.create_task(self._execute(item))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            if len(self.chat_buckets) > self.max_tracked_chats:
+                self._forget_idle_chats()
+
+    def _next_item(self):
+        """Следующий запрос, который можно отправить, или момент, когда проверить снова"""
+        now = time.monotonic()
+        wake = self.global_bucket.ready_at(now)
+        if wake > now:
+            return None, wake
+        wake = None
+        for item in sorted(self.items, key=lambda i: (i.priority, i.seq)):
+            if item.chat_id in self.busy_chats:
+                continue
+            ready = max(self._chat_bucket(item.chat_id).ready_at(now),
+                        self.blocked_until.get(item.chat_id, 0.0))
+            if ready <= now:
+                return item, None
+            wake = ready if wake is None else min(wake, ready)
+        return None, wake
+
+    async def _execute(self, item):
+        try:
+            result = await item.call()
+        except TelegramRetryAfter as e:
+            self.flood_waits += 1
+            self.blocked_until[item.chat_id] = time.monotonic() + e.retry_after
+            item.attempts += 1
+            logger.warning(f"Telegram просит подождать {e.retry_after} с (чат {item.chat_id})")
+            if item.attempts > self.max_retries:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            else:
+                self._requeue(item)
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self.busy_chats.discard(item.chat_id)
+            self._wakeup.set()
+
+    def _requeue(self, item):
+        if item.key is not None:
+            newer = self.edits.get(item.key)
+            if newer is not None:
+                # Пока ждали, пришла более свежая правка того же сообщения
+                self._chain(item, newer)
+                return
+            self.edits[item.key] = item
+        self.items.append(item)
+
+    def _drop_edits(self, key):
+        item = self.edits.pop(key, None)
+        if item is not None:
+            self.items.remove(item)
+            if not item.future.done():
+                item.future.set_result(None)
+            self.coalesced += 1
+
+    def _chain(self, old, new):
+        def forward(future):
+            if old.future.done():
+                return
+            if future.cancelled():
+                old.future.cancel()
+            elif future.exception() is not None:
+                old.future.set_exception(future.exception())
+            else:
+                old.future.set_result(future.result())
+        new.future.add_done_callback(forward)
+
+    def _forget_idle_chats(self):
+        """Забывает чаты с полным ведром, без очереди и без паузы от Telegram"""
+        now = time.monotonic()
+        waiting = {item.chat_id for item in self.items} | self.busy_chats
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id in waiting or self.blocked_until.get(chat_id, 0.0) > now:
+                continue
+            bucket.ready_at()
+            if bucket.level >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+                self.blocked_until.pop(chat_id, None)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = RateBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Пропускает запросы бота к чатам через OutboundQueue"""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        priority = _priority.get()
+        if priority is None:
+            is_status = isinstance(method, (EditMessageText, SendChatAction))
+            priority = PRIORITY_STATUS if is_status else PRIORITY_FINAL
+        edit_key = delete_key = None
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            edit_key = (chat_id, method.message_id)
+        elif isinstance(method, DeleteMessage):
+            delete_key = (chat_id, method.message_id)
+        return await self.queue.submit(
+            chat_id, lambda: make_request(bot, method), priority=priority,
+            edit_key=edit_key, delete_key=delete_key
+        )
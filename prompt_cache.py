@@ -0,0 +1,51 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Точка кэширования промпта (живёт ~5 минут с последнего обращения)
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def build_system_blocks(system_prompt, summary=None):
+    """Системная инструкция как отдельный блок с точкой кэширования.
+
+    Сводка старых реплик меняется редко, поэтому идет следующим блоком
+    со своей точкой кэширования и не сбивает кэш общей инструкции.
+    """
+    blocks = [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}]
+    if summary:
+        blocks.append({
+            "type": "text",
+            "text": f"Конспект попередньої розмови з цим користувачем:\n{summary}",
+            "cache_control": CACHE_CONTROL,
+        })
+    return blocks
+
+
+def build_cached_messages(history):
+    """Сообщения для Claude со скользящей точкой кэширования на последнем сообщении.
+
+    Следующий запрос того же пользователя начинается с этого же префикса,
+    поэтому он читается из кэша. Сама история не изменяется.
+    """
+    messages = [{"role": m["role"], "content": m["content"]} for m in history]
+    if messages:
+        last = messages[-1]
+        content = last["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        else:
+            content = [dict(block) for block in content]
+        content[-1]["cache_control"] = CACHE_CONTROL
+        last["content"] = content
+    return messages
+
+
+def log_usage(user_id, usage):
+    """Логирование расхода токенов, включая чтение и запись кэша"""
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    logger.info(
+        f"Токены пользователя {user_id}: вход={usage.input_tokens}, "
+        f"выход={usage.output_tokens}, кэш чтение={cache_read}, кэш запись={cache_write}"
+    )
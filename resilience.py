@@ -0,0 +1,175 @@
+import time
+import random
+import logging
+import asyncio
+from collections import deque
+import anthropic
+from limiter import is_overload_error
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Claude недоступен: запросы временно не отправляются"""
+
+
+def is_retryable(e):
+    """Временные ошибки, которые имеет смысл повторить.
+
+    429/529 сюда не входят: их повторяет общий ограничитель (limiter),
+    а предохранитель учитывает их, только когда тот сдался.
+    """
+    if isinstance(e, anthropic.APIConnectionError):
+        return True
+    if isinstance(e, anthropic.APIStatusError):
+        if is_overload_error(e):
+            return False
+        return e.status_code in (408, 409) or e.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """Предохранитель: после failure_threshold ошибок подряд запросы
+    отклоняются сразу в течение reset_timeout секунд, затем снова
+    пропускаются; первая же ошибка после этого размыкает его опять.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.half_open = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is not None:
+            return "open"
+        return "half_open" if self.half_open else "closed"
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            self.rejected += 1
+            raise CircuitOpenError()
+        # Пробуем снова; первая ошибка вернет предохранитель в разомкнутое состояние
+        self.opened_at = None
+        self.half_open = True
+
+    def record_success(self):
+        if self.half_open:
+            logger.info("Claude снова отвечает, предохранитель замкнут")
+        self.failures = 0
+        self.half_open = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.half_open or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error(f"Claude недоступен, запросы приостановлены на {self.reset_timeout} с")
+            self.opened_at = time.monotonic()
+            self.half_open = False
+
+
+class ResilientCaller:
+    """Повторы с экспоненциальной задержкой и случайным разбросом, дублирующие
+    (hedged) запросы и предохранитель вокруг запросов к Claude.
+
+    Дублирующий запрос отправляется, если ответ не пришел за время,
+    превышающее квантиль hedge_quantile недавних задержек; используется
+    ответ, пришедший первым. Дублирование (hedge_call) оборачивает только сам
+    запрос к Claude внутри места ограничителя: ожидание в очередях
+    не считается задержкой и не порождает дубликатов.
+    """
+
+    def __init__(self, breaker, max_attempts=3, base_delay=0.5, max_delay=8.0,
+                 hedge=False, hedge_quantile=0.95, hedge_min_samples=20):
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=200)
+        self.retries = 0
+        self.hedged = 0
+
+    async def run(self, call):
+        """Выполняет call() (функцию, возвращающую корутину) с повторами"""
+        self.breaker.check()
+        attempt = 0
+        while True:
+            try:
+                result = await call()
+            except Exception as e:
+                if is_overload_error(e):
+                    # Ограничитель уже исчерпал свои повторы: Claude перегружен,
+                    # и после нескольких таких ошибок запросы лучше сразу отклонять
+                    self.breaker.record_failure()
+                    raise
+                if not is_retryable(e):
+                    raise
+                self.breaker.record_failure()
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                self.breaker.check()
+                self.retries += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logger.warning(f"Ошибка Claude ({e.__class__.__name__}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def hedge_call(self, call, enabled=True):
+        """Запрос к Claude с дублированием, если оно включено (hedge) и разрешено"""
+        if not (enabled and self.hedge):
+            return await call()
+        return await self._hedged(call)
+
+    def hedge_delay(self):
+        """Порог задержки для дублирующего запроса (None, пока мало данных)"""
+        if len(self.latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_quantile))]
+
+    def stats(self):
+        return {
+            "circuit": self.breaker.state,
+            "rejected": self.breaker.rejected,
+            "retries": self.retries,
+            "hedged": self.hedged,
+            "hedge_delay": self.hedge_delay(),
+        }
+
+    async def _timed(self, call):
+        started = time.monotonic()
+        result = await call()
+        self.latencies.append(time.monotonic() - started)
+        return result
+
+    async def _hedged(self, call):
+        delay = self.hedge_delay()
+        first = asyncio.ensure_future(self._timed(call))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedged += 1
+                tasks.add(asyncio.ensure_future(self._timed(call)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
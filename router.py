@@ -0,0 +1,146 @@
+import re
+
+# Цены в долларах за миллион токенов: (вход, выход)
+MODEL_PRICES = {
+    "claude-3-5-haiku-20241022": (0.8, 4.0),
+    "claude-3-7-sonnet-20250219": (3.0, 15.0),
+}
+# Множители цены для чтения из кэша и записи в кэш
+CACHE_READ_PRICE_FACTOR = 0.1
+CACHE_WRITE_PRICE_FACTOR = 1.25
+
+# Темы запросов: основы слов (укр. и рус.), сравниваются с начала слова.
+# Основы — регулярные выражения, исключения вроде "больше" отсекаются заглядыванием вперед
+MEDICAL_KEYWORDS = (
+    "болит", "болить", "біль(?!ш)", "боль(?!ш)", "тиск", "давлен", "ліки", "ліків", "лікув",
+    "лекарств", "лечени", "таблет", "симптом", "діагноз", "диагноз", "хвороб", "болезн", "лікар", "врач",
+    "аналіз", "анализ", "депрес", "тривог", "тревог", "страх", "панік", "паник", "стрес",
+    "безсон", "бессон",
+)
+RECIPE_KEYWORDS = (
+    "рецепт", "пригот", "зварити", "сварить", "спекти", "испечь", "консерв", "засол", "закрут",
+    "варення", "варенье", "борщ", "вареник", "страв", "блюд",
+)
+# Прочие признаки сложного запроса (тоже с начала слова)
+COMPLEX_KEYWORDS = (
+    "шкідник", "вредител", "чому", "почему", "поясни", "объясни", "порівня", "сравни",
+    "таблиц", "план",
+)
+# Приветствия, благодарности и прощания, на которые достаточно быстрой модели.
+# "так", "ні", "да", "нет" сюда не входят: обычно это ответ на вопрос модели
+SMALL_TALK_PHRASES = (
+    "привіт", "привет", "вітаю", "здравствуйте", "добрий день", "добрый день",
+    "доброго дня", "доброго ранку", "доброе утро", "добрий вечір", "добрый вечер",
+    "дякую", "дуже дякую", "щиро дякую", "спасибі", "спасибо", "большое спасибо", "благодарю",
+    "до побачення", "до свидания", "бувай", "бувайте", "пока",
+)
+
+
+def _stems_pattern(stems):
+    return re.compile(r"\b(?:" + "|".join(stems) + ")")
+
+
+MEDICAL_PATTERN = _stems_pattern(MEDICAL_KEYWORDS)
+RECIPE_PATTERN = _stems_pattern(RECIPE_KEYWORDS)
+COMPLEX_PATTERN = _stems_pattern(COMPLEX_KEYWORDS)
+
+# Малый разговор — только если из таких фраз состоит весь текст
+_SMALL_TALK_PHRASE = "(?:" + "|".join(SMALL_TALK_PHRASES) + ")"
+SMALL_TALK_PATTERN = re.compile(_SMALL_TALK_PHRASE + r"(?: " + _SMALL_TALK_PHRASE + ")*")
+
+# Лимит длины ответа по классу запроса
+MAX_TOKENS_BY_CLASS = {
+    "small_talk": 200,
+    "general": 800,
+    "recipe": 1500,
+    "medical": 1200,
+    "ocr": 1200,
+}
+
+
+def classify_request(text, source="text"):
+    """Класс запроса: small_talk, recipe, medical, ocr или general"""
+    lowered = text.lower()
+    if source == "photo":
+        return "ocr"
+    # Малый разговор — это весь текст целиком, поэтому тем в нем нет
+    if is_small_talk(text):
+        return "small_talk"
+    if MEDICAL_PATTERN.search(lowered):
+        return "medical"
+    if RECIPE_PATTERN.search(lowered):
+        return "recipe"
+    return "general"
+
+
+def is_small_talk(text):
+    """Весь текст — приветствие, благодарность или прощание (без учета знаков и эмодзи)"""
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+    return bool(normalized) and SMALL_TALK_PATTERN.fullmatch(normalized) is not None
+
+
+def max_tokens_for(request_class):
+    """Лимит длины ответа для класса запроса"""
+    return MAX_TOKENS_BY_CLASS.get(request_class, MAX_TOKENS_BY_CLASS["general"])
+
+
+class ModelRouter:
+    """Выбор модели по дешевым локальным признакам запроса.
+
+    Приветствия, благодарности и простые короткие вопросы уходят быстрой
+    модели; медицинские, психологические, кулинарные темы, распознанный
+    с фото текст, длинные сообщения и глубокие разговоры — сильной.
+    По каждому маршруту считаются задержка и стоимость.
+    """
+
+    def __init__(self, fast_model, strong_model, fast_max_chars=200, fast_max_depth=6):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.fast_max_chars = fast_max_chars
+        self.fast_max_depth = fast_max_depth
+        self.metrics = {}
+
+    def choose(self, text, history, request_class):
+        """Возвращает (название маршрута, модель); request_class — см. classify_request"""
+        if request_class == "small_talk":
+            return "small_talk", self.fast_model
+        if request_class in ("ocr", "medical", "recipe"):
+            return request_class, self.strong_model
+        if COMPLEX_PATTERN.search(text.lower()):
+            return "complex", self.strong_model
+        if len(text) > self.fast_max_chars:
+            return "long", self.strong_model
+        # Глубина разговора в парах реплик
+        if len(history) // 2 > self.fast_max_depth:
+            return "deep", self.strong_model
+        return "simple", self.fast_model
+
+    def record(self, route, model, latency, usage):
+        """Учитывает задержку и стоимость запроса по маршруту"""
+        metrics = self.metrics.setdefault(route, {"requests": 0, "latency": 0.0, "cost": 0.0})
+        metrics["requests"] += 1
+        metrics["latency"] += latency
+        metrics["cost"] += request_cost(model, usage)
+
+    def stats(self):
+        return {
+            route: {
+                "requests": m["requests"],
+                "avg_latency": round(m["latency"] / m["requests"], 2),
+                "cost_usd": round(m["cost"], 4),
+            }
+            for route, m in self.metrics.items()
+        }
+
+
+def request_cost(model, usage):
+    """Стоимость запроса в долларах по response.usage"""
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return (
+        usage.input_tokens * input_price
+        + cache_read * input_price * CACHE_READ_PRICE_FACTOR
+        + cache_write * input_price * CACHE_WRITE_PRICE_FACTOR
+        + usage.output_tokens * output_price
+    ) / 1_000_000
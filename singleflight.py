@@ -0,0 +1,71 @@
+import json
+import hashlib
+import logging
+import asyncio
+
+logger = logging.getLogger(__name__)
+
+
+def request_fingerprint(request):
+    """Отпечаток запроса: модель, параметры, системная инструкция и сообщения"""
+    data = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.task = None
+        self.subscribers = []
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов в один.
+
+    Пока запрос с тем же отпечатком выполняется, новые вызовы не идут
+    к Claude, а ждут его результат. В потоковом режиме промежуточный
+    текст получают все ожидающие. Общий запрос отменяется, только если
+    его перестали ждать все вызовы.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.shared = 0
+
+    async def run(self, key, call, on_update=None):
+        """call(on_update) возвращает корутину запроса; on_update — None или функция"""
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = _Flight()
+            fanout = self._fanout(flight) if on_update is not None else None
+            flight.task = asyncio.create_task(call(fanout))
+            flight.task.add_done_callback(lambda _: self._finish(key, flight))
+        else:
+            self.shared += 1
+            logger.info("Одинаковый запрос уже выполняется, ждем его результат")
+        if on_update is not None:
+            flight.subscribers.append(on_update)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if on_update is not None and on_update in flight.subscribers:
+                flight.subscribers.remove(on_update)
+            if flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _fanout(self, flight):
+        async def fanout(text):
+            for subscriber in list(flight.subscribers):
+                try:
+                    await subscriber(text)
+                except Exception as e:
+                    logger.warning(f"Ошибка при рассылке промежуточного ответа: {e}")
+        return fanout
+
+    def _finish(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
@@ -0,0 +1,95 @@
+import time
+import logging
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from outbound import final_delivery
+from telegram_html import html_to_text
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram на длину одного сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class StreamingEditor:
+    """Постепенное обновление сообщения-заглушки по мере генерации ответа"""
+
+    def __init__(self, bot, chat_id, message_id, min_interval=1.0, min_chars=40, shown_text=""):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        # Правки объединяются: не чаще min_interval секунд и не меньше min_chars новых символов
+        self.min_interval = min_interval
+        self.min_chars = min_chars
+        # shown_text — текст, с которым сообщение уже отправлено
+        self.shown_text = shown_text
+        self.last_edit = time.monotonic() if shown_text else 0.0
+        self.first_edit_at = self.last_edit if shown_text else None
+        self.started_at = time.monotonic()
+
+    async def update(self, text):
+        """Показывает накопленный текст, если пора делать очередную правку"""
+        now = time.monotonic()
+        if now - self.last_edit < self.min_interval:
+            return
+        if len(text) - len(self.shown_text) < self.min_chars:
+            return
+        await self._edit(text[:TELEGRAM_MESSAGE_LIMIT])
+
+    async def finish(self, text, parse_mode=None):
+        """Заменяет заглушку окончательным ответом.
+
+        Возвращает False, если ответ не помещается в одно сообщение
+        и его нужно отправить отдельно.
+        """
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            return False
+        with final_delivery():
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    text=text,
+                    parse_mode=parse_mode,
+                )
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    return True
+                # Разметка не прошла проверку Telegram — показываем ответ без нее
+                logger.warning(f"Не удалось применить разметку к ответу: {e}")
+                if parse_mode == "HTML":
+                    text = html_to_text(text)
+                if text != self.shown_text:
+                    await self._edit(text)
+        return True
+
+    async def _edit(self, text):
+        self.last_edit = time.monotonic()
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=text,
+            )
+        except TelegramRetryAfter as e:
+            # Откладываем следующую правку, пока Telegram не разрешит
+            self.last_edit = time.monotonic() + e.retry_after
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.warning(f"Не удалось обновить сообщение: {e}")
+            return
+        self.shown_text = text
+        if self.first_edit_at is None:
+            self.first_edit_at = self.last_edit
+            logger.info(f"Первый фрагмент ответа показан через {self.first_edit_at - self.started_at:.2f} с")
+
+
+async def stream_claude_text(claude_client, on_update, **request):
+    """Запрос к Claude в потоковом режиме; on_update получает накопленный текст"""
+    text = ""
+    async with claude_client.messages.stream(**request) as stream:
+        async for delta in stream.text_stream:
+            text += delta
+            await on_update(text)
+        response = await stream.get_final_message()
+    return response
@@ -0,0 +1,91 @@
+import logging
+import asyncio
+from context_window import split_summary, with_summary
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Ти ведеш стислий конспект розмови користувача з консультантом.
+Онови конспект, додавши до нього нові репліки. Збережи факти про користувача
+(ім'я, здоров'я, город, тварини, уподобання), його питання та надані поради.
+Пиши українською, коротко, маркованим списком, без вступу."""
+
+
+class Summarizer:
+    """Фоновое сворачивание старых реплик в краткую сводку.
+
+    Отброшенные из контекста сообщения накапливаются по пользователю и
+    обрабатываются одной фоновой задачей на пользователя, вне пути ответа.
+    Готовая сводка сохраняется первой записью истории в хранилище.
+    """
+
+    def __init__(self, send_request, context_store, model, max_tokens=400, user_locks=None):
+        # send_request(request) выполняет запрос к Claude (через общие ограничители)
+        self.send_request = send_request
+        self.context_store = context_store
+        self.model = model
+        self.max_tokens = max_tokens
+        self.user_locks = user_locks
+        self.pending = {}
+        self.tasks = {}
+
+    def schedule(self, user_id, dropped):
+        """Ставит отброшенные сообщения в очередь на сворачивание"""
+        if not dropped:
+            return
+        self.pending.setdefault(user_id, []).extend(dropped)
+        if user_id not in self.tasks:
+            self.tasks[user_id] = asyncio.create_task(self._run(user_id))
+
+    def cancel(self, user_id):
+        """Отменяет сворачивание (например, после очистки истории)"""
+        self.pending.pop(user_id, None)
+        task = self.tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, user_id):
+        try:
+            while self.pending.get(user_id):
+                dropped = self.pending.pop(user_id)
+                summary, _ = split_summary(await self.context_store.get(user_id))
+                summary = await self.summarize(summary, dropped)
+                # За время запроса история могла измениться — берем свежие сообщения
+                if self.user_locks is not None:
+                    async with self.user_locks.hold(user_id):
+                        await self._save(user_id, summary)
+                else:
+                    await self._save(user_id, summary)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при сворачивании истории пользователя {user_id}: {e}")
+        finally:
+            if self.tasks.get(user_id) is asyncio.current_task():
+                del self.tasks[user_id]
+
+    async def _save(self, user_id, summary):
+        _, messages = split_summary(await self.context_store.get(user_id))
+        await self.context_store.set(user_id, with_summary(summary, messages))
+
+    async def summarize(self, summary, messages):
+        """Запрос к дешевой модели: старая сводка + новые реплики -> новая сводка"""
+        lines = []
+        if summary:
+            lines.append(f"Поточний конспект:\n{summary}\n")
+        lines.append("Нові репліки:")
+        for message in messages:
+            speaker = "Користувач" if message["role"] == "user" else "Консультант"
+            lines.append(f"{speaker}: {message['content']}")
+        response = await self.send_request(dict(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            system=SUMMARY_PROMPT,
+            messages=[{"role": "user", "content": "\n".join(lines)}],
+        ))
+        return response.content[0].text.strip()
@@ -0,0 +1,166 @@
+import re
+import html
+
+# Таблица шире этого числа символов показывается списком, а не моноширинным блоком
+TABLE_MAX_WIDTH = 40
+
+_FENCE = re.compile(r"^\s*(```|~~~)\s*([\w+-]*)\s*$")
+_HEADING = re.compile(r"^\s*#{1,6}\s+(.*?)\s*#*\s*$")
+_BULLET = re.compile(r"^(\s*)[-*+•]\s+(.*)$")
+_QUOTE = re.compile(r"^\s*>\s?(.*)$")
+_RULE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+_TABLE_ROW = re.compile(r"^\s*\|.*\|\s*$")
+_TABLE_SEPARATOR = re.compile(r"^\s*\|?(\s*:?-+:?\s*\|)+\s*(:?-+:?\s*)?$")
+
+# Строчная разметка: при пересечении побеждает шаблон, найденный раньше по тексту,
+# а при равенстве — стоящий выше в списке
+_INLINE = (
+    ("code", re.compile(r"`([^`\n]+)`")),
+    ("link", re.compile(r"\[([^\]\n]+)\]\(((?:https?://|tg://|mailto:)[^)\s]+)\)")),
+    ("b", re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*")),
+    ("b", re.compile(r"(?<!\w)__(?=\S)(.+?)(?<=\S)__(?!\w)")),
+    ("s", re.compile(r"~~(?=\S)(.+?)(?<=\S)~~")),
+    ("i", re.compile(r"(?<![\w*])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![\w*])")),
+    ("i", re.compile(r"(?<![\w_])_(?=[^\s_])(.+?)(?<=[^\s_])_(?![\w_])")),
+)
+
+
+def escape(text):
+    """Экранирование текста для parse_mode=HTML"""
+    return html.escape(text, quote=False)
+
+
+def render_markdown(text):
+    """Markdown из ответа Claude в HTML, который Telegram гарантированно примет.
+
+    Весь текст экранируется, теги создаются только парами. Заголовки
+    становятся жирным текстом, маркеры списков — точками, таблицы —
+    моноширинным блоком (узкие) или списком строк (широкие).
+    Непарные * и _ остаются как есть.
+    """
+    lines = text.split("\n")
+    out = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        fence = _FENCE.match(line)
+        if fence:
+            end = i + 1
+            while end < len(lines) and not lines[end].strip().startswith(fence.group(1)):
+                end += 1
+            code = escape("\n".join(lines[i + 1:end]))
+            language = fence.group(2)
+            if language:
+                out.append(f'<pre><code class="language-{language}">{code}</code></pre>')
+            else:
+                out.append(f"<pre>{code}</pre>")
+            i = end + 1
+            continue
+        if (_TABLE_ROW.match(line) and i + 1 < len(lines)
+                and _TABLE_SEPARATOR.match(lines[i + 1])):
+            end = i + 2
+            while end < len(lines) and _TABLE_ROW.match(lines[end]):
+                end += 1
+            out.append(_render_table(lines[i], lines[i + 2:end]))
+            i = end
+            continue
+        if _QUOTE.match(line):
+            end = i
+            while end < len(lines) and _QUOTE.match(lines[end]):
+                end += 1
+            quoted = [_QUOTE.match(l).group(1) for l in lines[i:end]]
+            out.append("<blockquote>" + "\n".join(render_inline(q) for q in quoted) + "</blockquote>")
+            i = end
+            continue
+        out.append(_render_line(line))
+        i += 1
+    return "\n".join(out)
+
+
+def render_inline(text):
+    """Строчная разметка: `код`, ссылки, **жирный**, *курсив*, ~~зачеркнутый~~"""
+    out = []
+    pos = 0
+    while pos < len(text):
+        found = None
+        for kind, pattern in _INLINE:
+            match = pattern.search(text, pos)
+            if match and (found is None or match.start() < found[1].start()):
+                found = (kind, match)
+        if found is None:
+            break
+        kind, match = found
+        out.append(escape(text[pos:match.start()]))
+        if kind == "code":
+            out.append(f"<code>{escape(match.group(1))}</code>")
+        elif kind == "link":
+            href = html.escape(match.group(2), quote=True)
+            out.append(f'<a href="{href}">{_render_plain_inline(match.group(1))}</a>')
+        else:
+            out.append(f"<{kind}>{render_inline(match.group(1))}</{kind}>")
+        pos = match.end()
+    out.append(escape(text[pos:]))
+    return "".join(out)
+
+
+def html_to_text(text):
+    """Текст без HTML-разметки (на случай, если Telegram все же ее отклонит)"""
+    return html.unescape(re.sub(r"<[^>]*>", "", text))
+
+
+def _render_plain_inline(text):
+    # Внутри ссылки другие ссылки недопустимы
+    return render_inline(text.replace("[", "(").replace("]", ")"))
+
+
+def _render_line(line):
+    if _RULE.match(line):
+        return "——————"
+    heading = _HEADING.match(line)
+    if heading:
+        return f"<b>{render_inline(_strip_emphasis(heading.group(1)))}</b>"
+    bullet = _BULLET.match(line)
+    if bullet:
+        return f"{bullet.group(1)}• {render_inline(bullet.group(2))}"
+    return render_inline(line)
+
+
+def _strip_emphasis(text):
+    """Заголовок и так жирный: **...** вокруг всего текста не нужны"""
+    match = re.fullmatch(r"(\*\*|__)(.+)\1", text)
+    return match.group(2) if match else text
+
+
+def _split_row(line):
+    cells = line.strip()
+    if cells.startswith("|"):
+        cells = cells[1:]
+    if cells.endswith("|"):
+        cells = cells[:-1]
+    return [c.strip() for c in cells.split("|")]
+
+
+def _render_table(header_line, row_lines):
+    header = [_plain(c) for c in _split_row(header_line)]
+    rows = [[_plain(c) for c in _split_row(l)] for l in row_lines]
+    columns = len(header)
+    rows = [(r + [""] * columns)[:columns] for r in rows]
+    widths = [max(len(r[c]) for r in [header] + rows) for c in range(columns)]
+    if sum(widths) + 3 * (columns - 1) <= TABLE_MAX_WIDTH:
+        lines = [header, ["-" * w for w in widths]] + rows
+        text = "\n".join(
+            " | ".join(cell.ljust(widths[c]) for c, cell in enumerate(r)).rstrip() for r in lines
+        )
+        return f"<pre>{escape(text)}</pre>"
+    # Широкая таблица: каждая строка — пункт с подписями столбцов
+    items = []
+    for r in rows:
+        first, rest = r[0], list(zip(header[1:], r[1:]))
+        details = "\n".join(f"   {escape(h)}: {escape(v)}" for h, v in rest if v)
+        items.append(f"• <b>{escape(first)}</b>" + (f"\n{details}" if details else ""))
+    return "\n".join(items)
+
+
+def _plain(cell):
+    """Ячейка таблицы без строчной разметки"""
+    return html_to_text(render_inline(cell))
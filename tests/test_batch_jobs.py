@@ -0,0 +1,187 @@
+import json
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from anthropic import AsyncAnthropic
+from batch_jobs import BatchJobRunner, FailedRequestBacklog, make_custom_id
+
+
+class FakeBatchApi:
+    """Локальная заглушка Message Batches API: пакет готов после нескольких опросов"""
+
+    def __init__(self, results, polls_until_ended=2):
+        self.results = results
+        self.polls_until_ended = polls_until_ended
+        self.created = []
+        self.polls = 0
+        self.server = None
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/v1/messages/batches", self._create)
+        app.router.add_get("/v1/messages/batches/{batch_id}", self._retrieve)
+        app.router.add_get("/v1/messages/batches/{batch_id}/results", self._results)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+    def client(self):
+        return AsyncAnthropic(api_key="test", base_url=str(self.server.make_url("")), max_retries=0)
+
+    def _batch(self, status):
+        return {
+            "id": "msgbatch_test",
+            "type": "message_batch",
+            "processing_status": status,
+            "request_counts": {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": "2026-01-01T00:00:00Z",
+            "expires_at": "2026-01-02T00:00:00Z",
+            "ended_at": "2026-01-01T00:10:00Z" if status == "ended" else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": (
+                str(self.server.make_url("/v1/messages/batches/msgbatch_test/results"))
+                if status == "ended" else None
+            ),
+        }
+
+    async def _create(self, request):
+        self.created.append(await request.json())
+        return web.json_response(self._batch("in_progress"))
+
+    async def _retrieve(self, request):
+        self.polls += 1
+        status = "ended" if self.polls > self.polls_until_ended else "in_progress"
+        return web.json_response(self._batch(status))
+
+    async def _results(self, request):
+        body = "\n".join(json.dumps(entry) for entry in self.results) + "\n"
+        return web.Response(body=body.encode("utf-8"), content_type="application/binary")
+
+
+def succeeded(custom_id, text):
+    return {"custom_id": custom_id, "result": {"type": "succeeded", "message": {
+        "id": f"msg_{custom_id}",
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-test",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": 5},
+    }}}
+
+
+def errored(custom_id):
+    return {"custom_id": custom_id, "result": {"type": "errored", "error": {
+        "type": "error", "error": {"type": "invalid_request_error", "message": "bad request"},
+    }}}
+
+
+def expired(custom_id):
+    return {"custom_id": custom_id, "result": {"type": "expired"}}
+
+
+def request(text):
+    return {"model": "claude-test", "max_tokens": 100, "messages": [{"role": "user", "content": text}]}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_run_creates_polls_and_delivers_results():
+    delivered = []
+
+    async def deliver(chat_id, text):
+        delivered.append((chat_id, text))
+
+    async def scenario():
+        results = [succeeded("digest-all", "Поради"), errored("backlog-3-0"), expired("backlog-4-1")]
+        async with FakeBatchApi(results) as api:
+            runner = BatchJobRunner(api.client(), deliver, poll_interval=0)
+            outcome = await runner.run("digest", [
+                ("digest-all", [1, 2], request("Поради на осінь")),
+                ("backlog-3-0", [3], request("Питання 3")),
+                ("backlog-4-1", [4], request("Питання 4")),
+            ])
+            return outcome, api
+
+    (delivered_count, failed_count), api = run(scenario())
+
+    assert len(api.created) == 1
+    assert [r["custom_id"] for r in api.created[0]["requests"]] == ["digest-all", "backlog-3-0", "backlog-4-1"]
+    assert api.created[0]["requests"][0]["params"] == request("Поради на осінь")
+    # Пакет опрашивается, пока не завершится, затем еще раз за адресом результатов
+    assert api.polls == 4
+    assert delivered == [(1, "Поради"), (2, "Поради")]
+    assert (delivered_count, failed_count) == (2, 2)
+
+
+def test_delivery_errors_are_counted_per_chat():
+    delivered = []
+
+    async def deliver(chat_id, text):
+        if chat_id == 2:
+            raise RuntimeError("chat not found")
+        delivered.append(chat_id)
+
+    async def scenario():
+        async with FakeBatchApi([succeeded("digest-all", "Поради")], polls_until_ended=0) as api:
+            runner = BatchJobRunner(api.client(), deliver, poll_interval=0)
+            return await runner.run("digest", [("digest-all", [1, 2, 3], request("Поради"))])
+
+    assert run(scenario()) == (2, 1)
+    assert delivered == [1, 3]
+
+
+def test_empty_job_does_not_create_batch():
+    async def scenario():
+        async with FakeBatchApi([]) as api:
+            runner = BatchJobRunner(api.client(), None, poll_interval=0)
+            return await runner.run("backlog", []), api
+
+    outcome, api = run(scenario())
+    assert outcome == (0, 0)
+    assert api.created == []
+
+
+def test_same_job_cannot_run_twice_at_once():
+    async def deliver(chat_id, text):
+        pass
+
+    async def scenario():
+        async with FakeBatchApi([succeeded("a", "x")], polls_until_ended=3) as api:
+            runner = BatchJobRunner(api.client(), deliver, poll_interval=0.05)
+            first = asyncio.create_task(runner.run("digest", [("a", [1], request("x"))]))
+            await asyncio.sleep(0.01)
+            try:
+                await runner.run("digest", [("a", [1], request("x"))])
+            except RuntimeError:
+                rejected = True
+            else:
+                rejected = False
+            return rejected, await first, runner.running
+
+    rejected, outcome, running = run(scenario())
+    assert rejected
+    assert outcome == (1, 0)
+    assert running == set()
+
+
+def test_make_custom_id_is_valid_for_batches_api():
+    custom_id = make_custom_id("digest", -1001234, "ю" * 80)
+    assert custom_id.startswith("digest--1001234-")
+    assert len(custom_id) == 64
+    assert set(custom_id) <= set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-")
+
+
+def test_failed_backlog_drain_empties_it():
+    backlog = FailedRequestBacklog(max_size=2)
+    for n in range(3):
+        backlog.add(n, n, f"text {n}")
+    assert backlog.drain() == [(1, 1, "text 1"), (2, 2, "text 2")]
+    assert backlog.drain() == []
@@ -0,0 +1,42 @@
+import pytest
+from router import ModelRouter, classify_request, max_tokens_for
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Привіт!", "small_talk"),
+    ("Дякую 🙏", "small_talk"),
+    ("Дуже дякую, до побачення!", "small_talk"),
+    ("большое спасибо", "small_talk"),
+    ("Так", "general"),
+    ("Напиши більше про сорти часнику", "general"),
+    ("скажи больше", "general"),
+    ("наблюдаю тлю на смородине", "general"),
+    ("Привіт, як посадити часник?", "general"),
+    ("Чому так болить голова?", "medical"),
+    ("Так, тиск 180 на 110, що робити?", "medical"),
+    ("Ні, а як лікувати кашель?", "medical"),
+    ("Сильная боль в спине", "medical"),
+    ("Дякую, а що робити, коли біль у коліні?", "medical"),
+    ("Да, а скільки варити борщ?", "recipe"),
+    ("Какое блюдо приготовить на ужин?", "recipe"),
+])
+def test_classify_request(text, expected):
+    assert classify_request(text) == expected
+
+
+def test_photo_text_is_ocr():
+    assert classify_request("Привіт!", source="photo") == "ocr"
+
+
+def test_topic_questions_get_their_own_limits():
+    assert max_tokens_for(classify_request("Чому так болить голова?")) == max_tokens_for("medical")
+    assert max_tokens_for(classify_request("большое спасибо")) == max_tokens_for("small_talk")
+    assert max_tokens_for("unknown") == max_tokens_for("general")
+
+
+def test_router_routes_by_class_and_complexity():
+    router = ModelRouter("fast", "strong")
+    assert router.choose("большое спасибо", [], "small_talk") == ("small_talk", "fast")
+    assert router.choose("Чому так болить голова?", [], "medical") == ("medical", "strong")
+    assert router.choose("Чому жовтіє листя?", [], "general") == ("complex", "strong")
+    assert router.choose("Яка сьогодні погода?", [], "general") == ("simple", "fast")
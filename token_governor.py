@@ -0,0 +1,113 @@
+import time
+import logging
+import asyncio
+from context_window import estimate_tokens, message_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_request_tokens(request):
+    """Оценка входных токенов запроса: системные блоки и сообщения"""
+    system = request.get("system") or []
+    if isinstance(system, str):
+        tokens = estimate_tokens(system)
+    else:
+        tokens = sum(estimate_tokens(block.get("text", "")) for block in system)
+    return tokens + sum(message_tokens(m) for m in request.get("messages", []))
+
+
+class TokenBucket:
+    """Ведро токенов, пополняемое с постоянной скоростью (лимит в минуту)"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Сколько секунд ждать, пока в ведре наберется amount (не больше емкости)"""
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        # Уровень может уйти в минус: долг гасится пополнением
+        self.refill()
+        self.level -= amount
+
+    def give_back(self, amount):
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class TokenGovernor:
+    """Учет лимитов Anthropic на входные и выходные токены в минуту.
+
+    Перед запросом его входные токены оцениваются локально, а выходные
+    резервируются по max_tokens; запрос ждет, пока оба ведра не наберут
+    нужный объем. После ответа резерв сверяется с response.usage и
+    разница возвращается в ведро (или списывается дополнительно).
+    """
+
+    def __init__(self, input_tokens_per_minute, output_tokens_per_minute):
+        self.input = TokenBucket(input_tokens_per_minute)
+        self.output = TokenBucket(output_tokens_per_minute)
+        self._lock = asyncio.Lock()
+        self.waited = 0
+        self.estimate_error = 0
+
+    async def run(self, request, call):
+        """Выполняет call() (функцию, возвращающую корутину), когда хватает токенов"""
+        input_tokens = estimate_request_tokens(request)
+        output_tokens = request.get("max_tokens", 0)
+        await self.admit(input_tokens, output_tokens)
+        try:
+            response = await call()
+        except BaseException:
+            # Неудачный запрос расходует входные токены, но не выходные
+            self.output.give_back(output_tokens)
+            raise
+        self.reconcile(input_tokens, output_tokens, response.usage)
+        return response
+
+    async def admit(self, input_tokens, output_tokens):
+        # Запросы допускаются по очереди, чтобы крупный не голодал за мелкими
+        async with self._lock:
+            while True:
+                delay = max(self.input.wait_time(input_tokens), self.output.wait_time(output_tokens))
+                if delay <= 0:
+                    break
+                self.waited += 1
+                logger.info(f"Лимит токенов Claude: запрос ждет {delay:.1f} с")
+                await asyncio.sleep(delay)
+            self.input.take(input_tokens)
+            self.output.take(output_tokens)
+
+    def reconcile(self, input_tokens, output_tokens, usage):
+        """Сверка резерва с фактическим расходом из response.usage"""
+        # Чтение из кэша во входной лимит не засчитывается, запись в кэш — засчитывается
+        actual_input = usage.input_tokens + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+        self.estimate_error = actual_input - input_tokens
+        if self.estimate_error > 0:
+            self.input.take(self.estimate_error)
+        else:
+            self.input.give_back(-self.estimate_error)
+        self.output.give_back(output_tokens - usage.output_tokens)
+
+    def stats(self):
+        self.input.refill()
+        self.output.refill()
+        return {
+            "input_tokens_available": int(self.input.level),
+            "output_tokens_available": int(self.output.level),
+            "waited": self.waited,
+            "last_estimate_error": self.estimate_error,
+        }
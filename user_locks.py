@@ -0,0 +1,47 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from dispatch import release_chat, resume_chat
+
+
+class UserLocks:
+    """Блокировки по пользователю: обновления одного пользователя идут по очереди,
+    разные пользователи обрабатываются параллельно.
+
+    Блокировка существует, только пока её кто-то держит или ждёт,
+    поэтому таблица не растёт с числом пользователей.
+    """
+
+    def __init__(self):
+        # user_id -> [блокировка, число держащих и ожидающих]
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        # Место в очереди пользователя занято — следующее обновление чата встанет за нами
+        release_chat()
+        try:
+            # asyncio.Lock пропускает ожидающих в порядке очереди
+            async with entry[0]:
+                # Пока ждали, место среди выполняющихся обработчиков занимали другие чаты
+                await resume_chat()
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def serialized(self, handler):
+        """Декоратор обработчика сообщений: один пользователь — один обработчик за раз"""
+        @functools.wraps(handler)
+        async def wrapper(message, *args):
+            async with self.hold(message.from_user.id):
+                return await handler(message, *args)
+        return wrapper
@@ -0,0 +1,91 @@
+import io
+import time
+import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import speech_recognition as sr
+from pydub import AudioSegment
+
+logger = logging.getLogger(__name__)
+
+
+class VoiceQueueFull(Exception):
+    """Слишком много голосовых сообщений ждут распознавания"""
+
+
+def transcribe_ogg(data, language="ru-RU"):
+    """Распознает речь в OGG-файле (байты); выполняется вне цикла событий"""
+    # Конвертируем из OGG в WAV для распознавания (pydub вызывает ffmpeg)
+    wav = io.BytesIO()
+    AudioSegment.from_file(io.BytesIO(data), format="ogg").export(wav, format="wav")
+    wav.seek(0)
+    recognizer = sr.Recognizer()
+    with sr.AudioFile(wav) as source:
+        audio_data = recognizer.record(source)
+    return recognizer.recognize_google(audio_data, language=language)
+
+
+class VoiceTranscriber:
+    """Распознавание голосовых сообщений в отдельном пуле потоков.
+
+    Конвертация и запрос к сервису распознавания блокируют поток, поэтому
+    они выполняются не больше чем в workers потоках и не задерживают
+    ответы остальным пользователям. Ждать очереди могут не больше
+    max_queued сообщений, остальным сразу отказывается (VoiceQueueFull).
+    """
+
+    def __init__(self, workers=2, max_queued=20, language="ru-RU"):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.language = language
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="voice")
+        self._slots = asyncio.Semaphore(workers)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.work_time = 0.0
+
+    async def transcribe(self, data):
+        """Текст голосового сообщения (байты OGG)"""
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise VoiceQueueFull()
+        queued_at = time.monotonic()
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        started = time.monotonic()
+        self.wait_time += started - queued_at
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(self.executor, transcribe_ogg, data, self.language)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.running -= 1
+            self.work_time += time.monotonic() - started
+            self._slots.release()
+        self.completed += 1
+        return text
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        done = self.completed + self.failed
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait": round(self.wait_time / done, 2) if done else 0.0,
+            "avg_time": round(self.work_time / done, 2) if done else 0.0,
+        }
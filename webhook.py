@@ -0,0 +1,62 @@
+import logging
+import asyncio
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """Прием обновлений Telegram через вебхук вместо long polling.
+
+    Обновления принимает очередь по чатам (ChatDispatcher): она
+    возвращает управление, как только обновление поставлено в очередь,
+    поэтому Telegram получает ответ 200 сразу, а при переполнении очереди
+    ответ задерживается. Сессию бота сервер не закрывает: после его
+    остановки вызывающий дожидается начатых обработчиков и закрывает ее
+    сам. Запросы без правильного секрета (X-Telegram-Bot-Api-Secret-Token)
+    отклоняются. Несколько копий бота за прокси регистрируют один и тот же
+    адрес и секрет.
+    """
+
+    def __init__(self, dp, bot, url, secret, path="/webhook", host="0.0.0.0", port=8080):
+        self.dp = dp
+        self.bot = bot
+        self.url = url.rstrip("/") + path
+        self.secret = secret
+        self.path = path
+        self.host = host
+        self.port = port
+        self.handler = None
+
+    def build_app(self):
+        app = web.Application()
+        self.handler = SimpleRequestHandler(
+            dispatcher=self.dp, bot=self.bot, handle_in_background=False, secret_token=self.secret
+        )
+        # Не через handler.register: он закрывает сессию бота при остановке сервера,
+        # раньше, чем начатые обработчики успеют отправить ответы
+        app.router.add_post(self.path, self.handler.handle)
+        app.router.add_get("/healthz", self._health)
+        setup_application(app, self.dp, bot=self.bot)
+        return app
+
+    async def run(self):
+        """Запускает сервер, регистрирует вебхук и работает до отмены"""
+        runner = web.AppRunner(self.build_app())
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+            await self.bot.set_webhook(
+                self.url,
+                secret_token=self.secret,
+                allowed_updates=self.dp.resolve_used_update_types(),
+            )
+            logger.info(f"Вебхук {self.url} зарегистрирован, сервер слушает {self.host}:{self.port}")
+            await asyncio.Event().wait()
+        finally:
+            # Вебхук не удаляется: другие копии бота продолжают принимать обновления
+            await runner.cleanup()
+
+    async def _health(self, request):
+        return web.Response(text="ok")